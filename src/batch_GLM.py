@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch fitting of every cell x family x graph of every session found
+under one or more folders.
+
+Usage (from src/):
+    python batch_GLM.py DATA_DIR [DATA_DIR ...] --ppm 600 --workers 32 \\
+        --output results.csv --predictions predictions/
+"""
+
+import os
+
+# Each worker process fits on a single core, multithreaded BLAS in every
+# process would oversubscribe the machine. Must be set before numpy loads.
+for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    os.environ.setdefault(variable, '1')
+
+import csv
+import time
+import argparse
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from compute_GLM import GLMPipeline
+from functions.neuron_functions import GLM_FAMILIES, grab_terode_cut_position_files
+from functions.Tint_Matlab import find_tetrodes, find_label_file
+from functions.design_matrix import COVARIATES
+
+GRAPHS = ['Rate', 'Rate_vs_Speed']
+
+# Graph label of fits on the --covariates design, which does not depend on the graph
+COVARIATES_GRAPH = 'covariates'
+
+FIELDS = ['session', 'tetrode', 'cell', 'family', 'graph', 'binning', 'n_spikes', 'group', 'rank',
+          'coefficients', 'deviance', 'aic', 'bic', 'converged', 'fit_time', 'cv_loglike', 'cv_pseudo_r2',
+          'cv_error', 'not_ranked', 'error']
+
+# =========================================================================== #
+
+def find_sessions(roots: list) -> list:
+
+    '''
+        Walks the given folders for recording sessions.
+
+        Params:
+            roots (list):
+                Folders to search
+
+        Returns:
+            list: (pos_file, cut_file, tetrode_file) of every sorted tetrode
+    '''
+
+    sessions = []
+    for root in roots:
+        for directory, _, files in os.walk(root):
+            set_files = sorted(file for file in files if file.endswith('.set'))
+
+            # Axona layout, session.set with session.N tetrodes and session_N.cut
+            # (or session.clu.N) label files
+            for set_file in set_files:
+                session = os.path.splitext(set_file)[0]
+                pos_file = os.path.join(directory, session + '.pos')
+                if not os.path.exists(pos_file):
+                    continue
+                for tetrode_file in sorted(find_tetrodes(os.path.join(directory, set_file))):
+                    # Tetrodes that were never sorted have no label file
+                    label_file = find_label_file(tetrode_file)
+                    if label_file is not None:
+                        sessions.append((pos_file, label_file, tetrode_file))
+
+            # Folders without a set file, one position, cut and tetrode file
+            if len(set_files) == 0:
+                tetrode_files, cut_files, pos_files = grab_terode_cut_position_files([directory])
+                if len(pos_files) == 1 and len(cut_files) == 1 and len(tetrode_files) == 1:
+                    sessions.append((pos_files[0], cut_files[0], tetrode_files[0]))
+
+    return sessions
+
+# =========================================================================== #
+
+# Pipeline of the session loaded by this process, every session is only loaded once per worker
+_pipelines = {}
+
+def _session_pipeline(files: tuple, ppm: int, options: dict) -> GLMPipeline:
+
+    if files not in _pipelines:
+        _pipelines.clear()
+        _pipelines[files] = GLMPipeline(files, ppm, **options)
+    return _pipelines[files]
+
+# =========================================================================== #
+
+def index_session(files: tuple, ppm: int, options: dict, graphs: list = None) -> tuple:
+
+    '''
+        Loads a session (filling the session cache) and returns the cells to
+        fit, every non empty unit except the unit 0 noise cluster. With
+        graphs, the Poisson models of every cell are also fitted at once for
+        each graph (see GLMPipeline.fit_poisson_units).
+
+        Returns:
+            Tuple: cells, poisson
+            --------
+            cells (list):
+                Cells to fit
+            poisson (dict):
+                (BatchedFit, fit time per cell) of every graph, one unit per
+                cell in cells order. Graphs whose batched fit failed are
+                left out, their cells are fitted one by one
+    '''
+
+    pipeline = _session_pipeline(files, ppm, options)
+    counts = pipeline.load()[0].counts
+    cells = [cell for cell in range(1, pipeline.load()[2] + 1) if counts[cell] > 0]
+
+    poisson = {}
+    if graphs and len(cells) > 0 and not pipeline.regularize and not pipeline.family_params:
+        for graph in graphs:
+            start = time.perf_counter()
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    fit = pipeline.fit_poisson_units(cells, graph)
+            except Exception:
+                continue
+            poisson[graph] = (fit, (time.perf_counter() - start) / len(cells))
+
+    return cells, poisson
+
+# =========================================================================== #
+
+def fit_cell(files: tuple, ppm: int, cell: int, families: list, graphs: list, options: dict,
+             cv_folds: int = 0, poisson: dict = None) -> tuple:
+
+    '''
+        Fits every family and graph of a cell, families are ranked by AIC 
+        within each graph and likelihood group (see 
+        compute_GLM.likelihood_group). With cv_folds, families are also cross-validated 
+        on that many time-block folds. poisson holds the batched Poisson 
+        fits of the tetrode, (BatchedFit, unit of the cell, fit time) per 
+        graph, which replace fitting the Poisson family again.
+
+        Returns:
+            Tuple: rows, predictions
+            --------
+            rows (list):
+                One dict per fit with the FIELDS of the results file
+            predictions (dict):
+                Prediction of every fit, keyed by 'cell/family/graph'
+    '''
+
+    pipeline = _session_pipeline(files, ppm, options)
+    n_spikes = int(pipeline.load()[0].counts[cell])
+
+    rows = []
+    predictions = {}
+    for graph in graphs:
+        # Every family of a graph is fitted on the same prepared data, the
+        # process pool already occupies every core so one thread is enough
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            prefit = {'Poisson': poisson[graph]} if poisson is not None and graph in poisson else None
+            comparison = pipeline.compare_families(cell, graph, families, workers=1, prefit=prefit)
+            scores = {}
+            if cv_folds > 1:
+                scores = {score.family: score for score in pipeline.cross_validate(cell, graph, families, cv_folds)}
+
+        for score in comparison:
+            row = {'session': files[0][:-4], 'tetrode': files[2], 'cell': cell, 'family': score.family,
+                   'graph': graph, 'binning': pipeline.binning, 'n_spikes': n_spikes, 'error': score.error}
+            if score.result is not None:
+                row.update(group=score.group, rank=score.rank, not_ranked=score.not_ranked, aic=score.aic, bic=score.bic, deviance=score.deviance,
+                           converged=score.converged, fit_time='%.4f' % score.fit_time,
+                           coefficients=' '.join(repr(float(p)) for p in np.ravel(score.result.params)))
+                predictions['%d/%s/%s' % (cell, score.family, graph)] = np.asarray(score.result.prediction, dtype=np.float32)
+            if score.family in scores:
+                cv = scores[score.family]
+                if cv.error is None:
+                    row.update(cv_loglike=cv.loglike, cv_pseudo_r2=cv.pseudo_r2)
+                else:
+                    row.update(cv_error=cv.error)
+            rows.append(row)
+
+    return rows, predictions
+
+# =========================================================================== #
+
+def run_batch(sessions: list, ppm: int, families: list, graphs: list, output: str,
+              predictions_dir: str = None, workers: int = None, options: dict | None = None, cv_folds: int = 0) -> int:
+
+    '''
+        Fits every cell of every session over a process pool and writes one
+        row per fit to the output CSV file. Predictions are written per
+        tetrode as .npz files into predictions_dir when given. With the
+        covariates option the graphs are ignored and every cell is fitted
+        once, under the COVARIATES_GRAPH label.
+
+        Returns:
+            int: Number of fits written
+    '''
+
+    options = dict(options) if options is not None else {}
+    if options.get('covariates') is not None:
+        graphs = [COVARIATES_GRAPH]
+    if predictions_dir is not None:
+        os.makedirs(predictions_dir, exist_ok=True)
+
+    n_rows = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+
+        # Load every session once, in parallel, fitting the Poisson family of
+        # all cells of a tetrode at once, then fan out one task per cell
+        batched_graphs = graphs if 'Poisson' in families else None
+        indexing = {pool.submit(index_session, files, ppm, options, batched_graphs): files for files in sessions}
+        fitting = {}
+        pending = {}
+        for future in as_completed(indexing):
+            files = indexing[future]
+            try:
+                cells, poisson = future.result()
+            except Exception as e:
+                print('Skipping %s: %s' % (files[2], e))
+                continue
+            pending[files] = [len(cells), {}]
+            for unit, cell in enumerate(cells):
+                prefit = {graph: (fit, unit, fit_time) for graph, (fit, fit_time) in poisson.items()}
+                fitting[pool.submit(fit_cell, files, ppm, cell, families, graphs, options, cv_folds, prefit)] = files
+
+        for future in as_completed(fitting):
+            files = fitting[future]
+            try:
+                rows, predictions = future.result()
+            except Exception as e:
+                print('Failed a cell of %s: %s' % (files[2], e))
+                rows, predictions = [], {}
+            writer.writerows(rows)
+            n_rows += len(rows)
+
+            # Write the predictions of a tetrode once all of its cells are done
+            pending[files][0] -= 1
+            pending[files][1].update(predictions)
+            if pending[files][0] == 0:
+                if predictions_dir is not None and len(pending[files][1]) > 0:
+                    # Named after the full tetrode path, sessions often share file names
+                    name = os.path.abspath(files[2]).strip(os.sep).replace(os.sep, '_').replace('.', '_') + '.npz'
+                    np.savez(os.path.join(predictions_dir, name), **pending[files][1])
+                del pending[files]
+
+    return n_rows
+
+# =========================================================================== #
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Fit GLMs to every cell of every session under the given folders.')
+    parser.add_argument('roots', nargs='+', help='Folders searched for sessions')
+    parser.add_argument('--ppm', type=int, default=600, help='Pixels per meter')
+    parser.add_argument('--families', nargs='+', default=list(GLM_FAMILIES), choices=list(GLM_FAMILIES))
+    parser.add_argument('--graphs', nargs='+', default=None, choices=GRAPHS,
+                        help='Graphs to fit, all by default. Not used with --covariates')
+    parser.add_argument('--binning', default='Adaptive', choices=['Adaptive', 'Fixed_grid'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--output', default='GLM_results.csv', help='Results CSV file')
+    parser.add_argument('--predictions', default=None, help='Folder for the predictions of every fit')
+    parser.add_argument('--cache-dir', default=None, help='Session cache folder')
+    parser.add_argument('--cv', type=int, default=0, metavar='K',
+                        help='Cross-validate every fit on K contiguous time-block folds')
+    parser.add_argument('--covariates', nargs='+', default=None, choices=list(COVARIATES),
+                        help='Fit on these design matrix blocks instead of the regressor of each graph')
+    parser.add_argument('--ridge', action='store_true',
+                        help='Fit ridge regularization paths, penalty chosen by cross-validation')
+    args = parser.parse_args()
+
+    # The covariates design replaces the regressor of every graph, each cell is fitted once
+    if args.covariates is not None:
+        if args.graphs is not None:
+            parser.error('--graphs cannot be combined with --covariates')
+        graphs = [COVARIATES_GRAPH]
+    else:
+        graphs = args.graphs if args.graphs is not None else GRAPHS
+
+    sessions = find_sessions(args.roots)
+    print('Found %d sorted tetrodes' % len(sessions))
+
+    options = {'binning': args.binning, 'cache_dir': args.cache_dir, 'covariates': args.covariates,
+               'regularize': args.ridge}
+    n_rows = run_batch(sessions, args.ppm, args.families, graphs, args.output,
+                       args.predictions, args.workers, options, args.cv)
+    print('Wrote %d fits to %s' % (n_rows, args.output))
+
+# =========================================================================== #
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks get_firing_rate_vs_time against the previous loop based
+implementation on a synthetic session.
+
+Run from the src folder:
+    python -m benchmarks.bench_firing_rate
+"""
+
+import time
+import numpy as np
+from functions.neuron_functions import get_firing_rate_vs_time
+
+# =========================================================================== #
+
+def legacy_get_firing_rate_vs_time(times: np.ndarray, pos_t: np.ndarray, window: int) -> tuple: 
+
+    '''
+        Previous implementation of get_firing_rate_vs_time, kept as a 
+        reference for timing and for checking the outputs.
+    '''
+
+    time_elapsed = 0
+    number_of_elements = 1
+    firing_rate = [0]
+    firing_time = [0]
+
+    for i in range(1, len(times)): 
+        if time_elapsed == 0: 
+            bin_time_start = times[i-1]
+        time_elapsed += (times[i] - times[i-1])
+        number_of_elements += 1
+        if time_elapsed > (window/1000): 
+            bin_time_end = bin_time_start + time_elapsed
+            firing_rate.append(number_of_elements/time_elapsed)
+            firing_time.append( (bin_time_start + bin_time_end)/2 )
+            time_elapsed = 0
+            number_of_elements = 0
+
+    rate_vector = np.zeros((len(pos_t), 1))
+    index_values = []
+    for i in range(len(firing_time)):
+        index_values.append(  (np.abs(pos_t - firing_time[i])).argmin()  )
+        
+    firing_rate = np.array(firing_rate).reshape((len(firing_rate), 1))
+    rate_vector[index_values] = firing_rate
+
+    return rate_vector, firing_time
+
+# =========================================================================== #
+
+def benchmark(duration: float, rate: float, pos_rate: float = 50, seed: int = 0) -> None: 
+
+    '''
+        Times both implementations on a Poisson spike train of the given 
+        rate (Hz) over a session of the given duration (s).
+    '''
+
+    rng = np.random.default_rng(seed)
+    times = np.sort(rng.uniform(0, duration, int(duration * rate)))
+    pos_t = (np.arange(int(duration * pos_rate)) / pos_rate).reshape(-1, 1)
+
+    start = time.perf_counter()
+    rate_vector, firing_time = get_firing_rate_vs_time(times, pos_t, 400)
+    new_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy_rate_vector, legacy_firing_time = legacy_get_firing_rate_vs_time(times, pos_t, 400)
+    legacy_time = time.perf_counter() - start
+
+    same = (np.allclose(rate_vector, legacy_rate_vector) and 
+            np.allclose(firing_time, legacy_firing_time))
+    
+    print('%6d s session, %5.1f Hz unit: legacy %8.3f s, vectorized %7.4f s, speedup %7.1fx, outputs match: %s' 
+          % (duration, rate, legacy_time, new_time, legacy_time / new_time, same))
+    
+# =========================================================================== #
+
+if __name__ == '__main__':
+    for duration, rate in [(600, 2), (600, 30), (3600, 2), (3600, 30)]:
+        benchmark(duration, rate)
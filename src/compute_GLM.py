@@ -4,86 +4,503 @@ Created on Mon Nov 22 15:49:58 2021
 
 @author: vajra
 """
+import time
 import numpy as np
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import pyplot as plt
 from functions.neuron_functions import *
 from functions.Tint_Matlab import speed2D
+from functions.session_cache import load_session
+from functions.design_matrix import DesignMatrix
+from functions.batched_glm import fit_poisson_batch
+from functions.cross_validation import cross_validate
+from functions.regularized_glm import REGULARIZED_FAMILIES, regularization_path
 
 # =========================================================================== #  
-def compute_GLM(self, files, cell, ppm, family: str, graph: str, **kwargs):
-    
-    # Instantiate error message as None
-    error = None
-    
-    # Grab position, tetrode and cut file
-    pos_file = files[0]
-    cut_file = files[1]
-    tetrode_file = files[2]
-    
-    # If kwarg exists, no need to repeat computation
-    cell_data = kwargs.get('cell_data', None)
-    if cell_data == None: 
-        # Loading raw spike data from tetrode 
-        raw_spike_data, empty_cell = load_neurons(cut_file, tetrode_file, channel_no=1)
-        final_cell = len(raw_spike_data) - 1
-        # Grab position data
-        pos_x, pos_y, pos_t, arena_size = grab_position_data(pos_file, ppm)
-        cell_data = (raw_spike_data, (pos_x, pos_y, pos_t, arena_size), final_cell)
-    else:
-        raw_spike_data = cell_data[0]
-        pos_x, pos_y, pos_t, arena_size = cell_data[1][0], cell_data[1][1], cell_data[1][2], cell_data[1][3]
-        final_cell = cell_data[2]
-    
-    # Emit 25% progress done for progress bar
-    self.signals.progress.emit(25)
-                
-    # Load neuron data and organize
-    unit_data = raw_spike_data[cell][1]
-    firing_data, firing_time = get_firing_rate_vs_time(unit_data, pos_t, 400)
-    speed = speed2D(pos_x, pos_y, pos_t)
-    
-    self.signals.progress.emit(50)
-    
-    # Instantiate endogenous and exogenous variables 
-    y1 = firing_data.flatten()
-    x1 = pos_t.flatten()
-    y2 = firing_data.flatten()
-    x2 = speed.flatten()
-    
-    # Determine what model to predict with based on user choice
-    model_rate = choose_GLM_model(x1, y1, family)
-    model_rate_and_speed = choose_GLM_model(x2, y2, family)
-    
-    self.signals.progress.emit(75)
-    
-    # Predict 
-    if graph == 'Rate':
-        try:
+class PipelineCallbacks: 
+    
+    '''
+        Callback protocol through which a GLMPipeline reports its progress 
+        (0 to 100) and errors, and learns that it was cancelled. This default 
+        implementation ignores progress and errors and is never cancelled, 
+        any object with the same methods can be passed instead.
+    '''
+    
+    def progress(self, value: int) -> None:
+        pass
+    
+    # ------------------------------------------- #  
+    
+    def error(self, message: str) -> None:
+        pass
+    
+    # ------------------------------------------- #  
+    
+    def is_cancelled(self) -> bool:
+        return False
+
+# =========================================================================== #  
+@dataclass
+class GLMResult: 
+    
+    '''
+        Fitted GLM of one cell, family and graph. 
+        
+        x is the regressor (time or speed), y the firing rate of the cell 
+        and prediction the fitted rate at every x.
+    '''
+    
+    cell: int
+    family: str
+    graph: str
+    x: np.ndarray
+    y: np.ndarray
+    prediction: np.ndarray
+    params: np.ndarray
+    deviance: float
+    aic: float
+    bic: float
+    converged: bool
+    fit_time: float
+
+# =========================================================================== #  
+@dataclass
+class FamilyComparison: 
+    
+    '''
+        One row of a family comparison table. The scores are NaN and error 
+        holds the message when the fit failed.
+        
+        AICs are only comparable between families fit on the same response 
+        with the same kind of likelihood (see likelihood_group), rank is the 
+        AIC rank within that group. Fits the data cannot support have no rank 
+        and not_ranked holds the reason.
+    '''
+    
+    family: str
+    aic: float = np.nan
+    bic: float = np.nan
+    deviance: float = np.nan
+    converged: bool = False
+    fit_time: float = np.nan
+    error: str = None
+    result: GLMResult = None
+    group: str = None
+    rank: int = None
+    not_ranked: str = None
+
+# =========================================================================== #  
+
+# Kind of likelihood of every family. Count probabilities, densities of a 
+# continuous response and the Tweedie and Binomial likelihoods are not on the 
+# same scale, their AICs cannot be compared.
+LIKELIHOOD_KINDS = {
+    'Poisson': 'discrete',
+    'Negative Binomial': 'discrete',
+    'Binomial': 'binomial',
+    'Gaussian': 'continuous',
+    'Gamma': 'continuous',
+    'Inverse Gaussian': 'continuous',
+    'Tweedie': 'tweedie',
+}
+
+def likelihood_group(family: str, model_family, y: np.ndarray, exposure: np.ndarray, aic: float) -> tuple: 
+    
+    '''
+        Group of families whose AICs can be compared with that of a fit: the 
+        kind of likelihood, and the response it was fit on (spike counts for 
+        log link families with an exposure, the rate otherwise, see 
+        choose_GLM_model). 
+        
+        Params: 
+            family (str): 
+                One of the keys of GLM_FAMILIES
+            model_family (statsmodels family): 
+                Family of the fitted model
+            y, exposure (np.ndarray): 
+                Prepared fitting data
+            aic (float): 
+                AIC of the fit
+        
+        Returns: 
+            Tuple: group, not_ranked
+            --------
+            group (str): 
+                e.g. 'discrete, counts' or 'continuous, rate'
+            not_ranked (str): 
+                Why the fit cannot be ranked, None if it can
+    '''
+    
+    scale = 'counts' if exposure is not None and isinstance(model_family.link, sm.families.links.Log) else 'rate'
+    
+    not_ranked = unsupported_response(family, fitted_response(y, exposure, model_family))
+    if not_ranked is None and not np.isfinite(aic):
+        not_ranked = 'Non-finite AIC'
+    
+    return '%s, %s' % (LIKELIHOOD_KINDS.get(family, family), scale), not_ranked
+
+# =========================================================================== #  
+class GLMPipeline: 
+    
+    '''
+        Fits GLMs to the cells of a session, in stages: load, bin, covariates, 
+        fit and predict. The loaded session and the last binned cell are kept, 
+        so fitting several families or graphs of a cell only repeats the fit.
+        
+        Params: 
+            files (list): 
+                Position, cut and tetrode file paths
+            ppm (int): 
+                Pixel per meter value 
+            callbacks (PipelineCallbacks): 
+                Receives progress and errors, ignored if None
+            **options: 
+                binning ('Adaptive' or 'Fixed_grid'), speed_window, 
+                family_params, cache_dir, cell_data to reuse an already 
+                loaded session, covariates, a list of DesignMatrix 
+                blocks to fit on instead of the regressor of the graph, and 
+                regularize to fit REGULARIZED_FAMILIES along a ridge path 
+                with the penalty chosen by cross-validation
+    '''
+    
+    def __init__(self, files: list, ppm: int, callbacks: PipelineCallbacks = None, **options):
+        
+        self.files = files
+        self.ppm = ppm
+        self.callbacks = callbacks if callbacks is not None else PipelineCallbacks()
+        self.cell_data = options.pop('cell_data', None)
+        # Binning mode: 'Adaptive' (rate over ~400ms of spikes) or 'Fixed_grid' (counts per position sample)
+        self.binning = options.pop('binning', 'Adaptive')
+        self.family_params = options.pop('family_params', {})
+        self.covariate_specs = options.pop('covariates', None)
+        self.regularize = options.pop('regularize', False)
+        self.options = options
+        self._binned = None
+    
+    # ------------------------------------------- #  
+    
+    def load(self) -> tuple:
+        
+        '''
+            Loads the spike index, position data and speed of the session. 
             
-            predictor = model_rate.fit()
-            prediction = predictor.predict(x1)
+            Returns: 
+                cell_data (tuple): raw_spike_data, (pos_x, pos_y, pos_t, arena_size, tracking, pos_hd), final_cell, speed
+        '''
+        
+        if self.cell_data is None:
+            pos_file, cut_file, tetrode_file = self.files[0], self.files[1], self.files[2]
+            # Loading raw spike data from tetrode and position data, 
+            # memory-mapped from the session cache when possible
+            raw_spike_data, empty_cell, position_data = load_session(pos_file, cut_file, tetrode_file, self.ppm, 
+                                                                     self.options.get('cache_dir', None))
+            final_cell = len(raw_spike_data) - 1
+            pos_x, pos_y, pos_t, arena_size, tracking, pos_hd = position_data
+            # Speed only depends on the session, computed once and reused for every cell and family
+            speed = speed2D(pos_x, pos_y, pos_t, self.options.get('speed_window', None))
+            self.cell_data = (raw_spike_data, (pos_x, pos_y, pos_t, arena_size, tracking, pos_hd), final_cell, speed)
             
-        except Exception as e:
+        return self.cell_data
+    
+    # ------------------------------------------- #  
+    
+    def bin(self, cell: int) -> tuple:
+        
+        '''
+            Bins the spikes of a cell. 
             
+            Returns: 
+                Tuple: firing_data, exposure (bin durations, None for adaptive binning)
+        '''
+        
+        if self._binned is not None and self._binned[0] == cell:
+            return self._binned[1]
+        
+        cell_data = self.load()
+        pos_t = cell_data[1][2]
+        
+        # Load neuron data and organize
+        unit_data = cell_data[0].times_for(cell)
+        if self.binning == 'Fixed_grid':
+            # Spike counts per position sample, bin durations enter the model as exposure
+            firing_data, exposure = get_spike_counts_vs_time(unit_data, pos_t)
+        else:
+            firing_data, firing_time = get_firing_rate_vs_time(unit_data, pos_t, 400)
+            exposure = None
+        
+        self._binned = (cell, (firing_data, exposure))
+        return firing_data, exposure
+    
+    # ------------------------------------------- #  
+    
+    def axis(self, graph: str) -> np.ndarray:
+        
+        '''
+            Regressor of a graph, speed for the rate vs speed graph and time 
+            otherwise (the rate graph, and fits on the covariates option).
+        '''
+        
+        cell_data = self.load()
+        if graph == 'Rate_vs_Speed':
+            return cell_data[3].flatten()
+        return cell_data[1][2].flatten()
+    
+    # ------------------------------------------- #  
+    
+    def covariates(self, graph: str) -> np.ndarray:
+        
+        '''
+            Design the model is fit on. The regressor of the graph, or the 
+            design matrix of the covariates option, shared by every cell of 
+            the session.
+        '''
+        
+        if self.covariate_specs is None:
+            return self.axis(graph)
+        return DesignMatrix.for_session(self.load()).build(self.covariate_specs)[0]
+    
+    # ------------------------------------------- #  
+    
+    def prepare(self, x: np.ndarray, firing_data: np.ndarray, exposure: np.ndarray) -> tuple: 
+        
+        '''
+            Fitting data without missing values, shared by every family. 
             
-            error = str(e)
-            self.signals.error.emit(error)
-            return
+            Returns: 
+                Tuple: x_fit, y_fit, exposure_fit
+        '''
+        
+        return prepare_GLM_data(x, firing_data.flatten(), exposure)
+    
+    # ------------------------------------------- #  
+    
+    def fit(self, prepared: tuple, family: str): 
+        
+        '''
+            Fits the model of the chosen family only, on prepared data. 
+            Returns the statsmodels fit results, or the RidgeResults of the 
+            regularization path if regularize is set.
+        '''
+        
+        x_fit, y_fit, exposure_fit = prepared
+        if self.regularize and family in REGULARIZED_FAMILIES:
+            return regularization_path(x_fit, y_fit, family, exposure_fit, **self.family_params)
+        
+        model = choose_GLM_model(x_fit, y_fit, family, exposure_fit, prepared=True, **self.family_params)
         
-        self.signals.progress.emit(100)
-        return cell_data, x1, y1, prediction
+        return model.fit()
     
-    else:
+    # ------------------------------------------- #  
+    
+    def predict(self, predictor, x: np.ndarray) -> np.ndarray:
+        return predictor.predict(x)
+    
+    # ------------------------------------------- #  
+    
+    def run(self, cell: int, family: str, graph: str) -> GLMResult:
+        
+        '''
+            Runs every stage for a cell, family and graph. Errors are 
+            reported through the callbacks, in which case None is returned. 
+            None is also returned, silently, when the callbacks report a 
+            cancellation between two stages.
+        '''
+        
+        cancelled = self.callbacks.is_cancelled
         try:
             
-            predictor_rate = model_rate_and_speed.fit()
-            prediction = predictor_rate.predict(x2)
+            self.load()
+            self.callbacks.progress(25)
+            if cancelled():
+                return
+            
+            firing_data, exposure = self.bin(cell)
+            X = self.covariates(graph)
+            self.callbacks.progress(50)
+            if cancelled():
+                return
+            
+            start = time.perf_counter()
+            predictor = self.fit(self.prepare(X, firing_data, exposure), family)
+            fit_time = time.perf_counter() - start
+            self.callbacks.progress(75)
+            if cancelled():
+                return
+            
+            result = self._result(cell, family, graph, X, firing_data, exposure, predictor, fit_time)
             
         except Exception as e:
-            error = str(e)
-            self.signals.error.emit(error)
+            self.callbacks.error(str(e))
             return
         
-        self.signals.progress.emit(100)
-        return cell_data, x2, y2, prediction
-    
\ No newline at end of file
+        self.callbacks.progress(100)
+        return result
+    
+    # ------------------------------------------- #  
+    
+    def compare_families(self, cell: int, graph: str, families: list = None, workers: int = None, 
+                         prefit: dict = None) -> list:
+        
+        '''
+            Fits every family for a cell and graph, on a thread pool of the 
+            given size (one thread per family if None). Binning and data 
+            preparation are shared. Failed fits are reported in their row, 
+            not through the callbacks.
+            
+            prefit maps families already fitted for several cells at once 
+            to (BatchedFit, unit of the cell, fit_time), see 
+            fit_poisson_units. Units the batched fit could not fit are 
+            refitted here.
+            
+            statsmodels fits of a single cell spend most of their time in 
+            Python code holding the GIL, so the threads mostly keep the GUI 
+            responsive rather than fit in parallel. Batches get their 
+            parallelism from processes, see batch_GLM.
+            
+            Returns: 
+                list: FamilyComparison rows ranked by AIC within each 
+                likelihood group (groups in GLM_FAMILIES order), then the 
+                rows that cannot be ranked and the failed fits
+        '''
+        
+        if families is None:
+            families = list(GLM_FAMILIES)
+        
+        firing_data, exposure = self.bin(cell)
+        X = self.covariates(graph)
+        prepared = self.prepare(X, firing_data, exposure)
+        self.callbacks.progress(25)
+        
+        def compare(family):
+            if self.callbacks.is_cancelled():
+                return FamilyComparison(family, error='Cancelled')
+            try:
+                predictor = None
+                if prefit is not None and family in prefit:
+                    fit, unit, fit_time = prefit[family]
+                    if fit.converged[unit]:
+                        predictor = fit.unit(unit, *prepared)
+                if predictor is None:
+                    start = time.perf_counter()
+                    predictor = self.fit(prepared, family)
+                    fit_time = time.perf_counter() - start
+                result = self._result(cell, family, graph, X, firing_data, exposure, predictor, fit_time)
+                group, not_ranked = likelihood_group(family, predictor.family, prepared[1], prepared[2], 
+                                                     result.aic)
+            except Exception as e:
+                return FamilyComparison(family, error=str(e))
+            return FamilyComparison(family, result.aic, result.bic, result.deviance, result.converged, 
+                                    fit_time, result=result, group=group, not_ranked=not_ranked)
+        
+        with ThreadPoolExecutor(max_workers=workers or len(families)) as pool:
+            rows = list(pool.map(compare, families))
+        self.callbacks.progress(100)
+        
+        # Rank within each group, groups ordered by their first family
+        order = list(GLM_FAMILIES)
+        ranked = [row for row in rows if row.error is None and row.not_ranked is None]
+        groups = {}
+        for row in sorted(ranked, key=lambda row: row.aic):
+            groups.setdefault(row.group, []).append(row)
+            row.rank = len(groups[row.group])
+        group_order = {group: min(order.index(row.family) for row in members) for group, members in groups.items()}
+        
+        ranked.sort(key=lambda row: (group_order[row.group], row.rank))
+        unranked = [row for row in rows if row.error is None and row.not_ranked is not None]
+        failed = [row for row in rows if row.error is not None]
+        
+        return ranked + unranked + failed
+    
+    # ------------------------------------------- #  
+    
+    def cross_validate(self, cell: int, graph: str, families: list = None, k: int = 5, gap: int = 0, 
+                       workers: int = 1) -> list:
+        
+        '''
+            Held-out log-likelihood and pseudo R2 of the families for a cell 
+            and graph, on k contiguous time-block folds (see 
+            functions.cross_validation.cross_validate).
+            
+            Returns: 
+                list: CrossValidation of every family
+        '''
+        
+        firing_data, exposure = self.bin(cell)
+        prepared = self.prepare(self.covariates(graph), firing_data, exposure)
+        
+        return cross_validate(*prepared, families=families, k=k, gap=gap, workers=workers, 
+                              family_params=self.family_params)
+    
+    # ------------------------------------------- #  
+    
+    def fit_poisson_units(self, cells: list, graph: str):
+        
+        '''
+            Fits the Poisson model of several cells at once, they share the 
+            design so the IRLS iterations of every cell are batched (see 
+            fit_poisson_batch). This is the model fit builds for the 
+            Poisson family when regularize is not set. 
+            
+            Returns: 
+                BatchedFit: one column of params per cell
+        '''
+        
+        X = self.covariates(graph)
+        binned = [self.bin(cell) for cell in cells]
+        Y = np.column_stack([firing_data.flatten() for firing_data, _ in binned])
+        # Bins only depend on the position samples, the exposure is shared too
+        exposure = binned[0][1]
+        
+        return fit_poisson_batch(X, Y, exposure)
+    
+    # ------------------------------------------- #  
+    
+    def _result(self, cell, family, graph, X, firing_data, exposure, predictor, fit_time) -> GLMResult:
+        
+        # Predicted at every sample, plotted against the regressor of the graph
+        prediction = self.predict(predictor, X)
+        x = self.axis(graph)
+        
+        # Counts are returned as rates (Hz) for plotting
+        y = firing_data.flatten()
+        if exposure is not None:
+            y = y / exposure
+        
+        return GLMResult(cell, family, graph, x, y, prediction, predictor.params, predictor.deviance, 
+                         predictor.aic, predictor.bic_llf, predictor.converged, fit_time)
+
+# =========================================================================== #  
+def compute_GLM(callbacks, files, cell, ppm, family: str, graph: str, **kwargs):
+    
+    '''
+        Runs a GLMPipeline and returns its result in the tuple form used by 
+        the GUI: cell_data, x, y, prediction, params, deviance. Returns None 
+        on error, which is reported through callbacks, or cancellation.
+    '''
+    
+    pipeline = GLMPipeline(files, ppm, callbacks, **kwargs)
+    result = pipeline.run(cell, family, graph)
+    if result is None:
+        return
+    
+    return pipeline.cell_data, result.x, result.y, result.prediction, result.params, result.deviance
+
+# =========================================================================== #  
+def compare_GLM_families(callbacks, files, cell, ppm, graph: str, **kwargs):
+    
+    '''
+        Runs GLMPipeline.compare_families for the GUI. Returns the ranked 
+        FamilyComparison rows, None on error or cancellation.
+    '''
+    
+    pipeline = GLMPipeline(files, ppm, callbacks, **kwargs)
+    try:
+        rows = pipeline.compare_families(cell, graph)
+    except Exception as e:
+        callbacks.error(str(e))
+        return
+    if callbacks.is_cancelled():
+        return
+    
+    return rows
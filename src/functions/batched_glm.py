@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Poisson GLM fitted to every unit of a tetrode at once. All units share the
+design matrix, so each IRLS iteration solves the weighted normal equations of
+every unit with batched linear algebra instead of one statsmodels fit per unit.
+"""
+
+import numpy as np
+import statsmodels.api as sm
+from dataclasses import dataclass, field
+from scipy.special import gammaln, xlogy
+
+# =========================================================================== #
+
+@dataclass
+class BatchedFit:
+
+    '''
+        Poisson fits of several units, one column (or entry) per unit.
+    '''
+
+    params: np.ndarray          # n_params x n_units coefficients
+    deviance: np.ndarray        # Deviance of every unit
+    converged: np.ndarray       # Whether every unit converged
+    n_iter: int                 # IRLS iterations run
+
+    # ------------------------------------------- #
+
+    def predict(self, X: np.ndarray, exposure: np.ndarray = None) -> np.ndarray:
+
+        '''
+            Predicted mean (rate, or count if exposure is given) of every
+            unit, n_samples x n_units.
+        '''
+
+        eta = np.asarray(X, dtype=float).reshape((len(X), -1)) @ self.params
+        if exposure is not None:
+            eta += np.log(exposure).reshape((-1, 1))
+        return np.exp(eta)
+
+    # ------------------------------------------- #
+
+    def unit(self, unit: int, X: np.ndarray, y: np.ndarray, exposure: np.ndarray = None):
+
+        '''
+            Fit of one unit in the place of statsmodels fit results, scored
+            on the data of the unit without missing values (see
+            prepare_GLM_data).
+
+            Returns:
+                UnitFit
+        '''
+
+        X = np.asarray(X, dtype=float).reshape((len(X), -1))
+        y = np.asarray(y, dtype=float).flatten()
+        params = self.params[:, unit]
+
+        mu = np.exp(X @ params)
+        if exposure is not None:
+            mu *= np.asarray(exposure, dtype=float).flatten()
+        llf = np.sum(xlogy(y, mu) - mu - gammaln(y + 1))
+        deviance = 2 * np.sum(xlogy(y, y) - xlogy(y, mu) - (y - mu))
+
+        # Same parameter count as statsmodels, the rank of the design
+        k = np.linalg.matrix_rank(X)
+        return UnitFit(params, deviance, llf, -2 * llf + 2 * k, -2 * llf + np.log(len(y)) * k,
+                       bool(self.converged[unit]))
+
+# =========================================================================== #
+
+@dataclass
+class UnitFit:
+
+    '''
+        Poisson fit of one unit of a BatchedFit, with the attributes of
+        statsmodels fit results that GLMPipeline uses.
+    '''
+
+    params: np.ndarray
+    deviance: float
+    llf: float
+    aic: float
+    bic_llf: float
+    converged: bool
+    family: sm.families.Family = field(default_factory=sm.families.Poisson)
+
+    # ------------------------------------------- #
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+
+        '''
+            Predicted rate, like statsmodels predict without an exposure.
+        '''
+
+        return np.exp(np.asarray(X, dtype=float).reshape((len(X), -1)) @ self.params)
+
+# =========================================================================== #
+
+def fit_poisson_batch(X: np.ndarray, Y: np.ndarray, exposure: np.ndarray = None, max_iter: int = 100,
+                      tol: float = 1e-8, max_bytes: int = 2**29, warm_start_rows: int = 16384,
+                      start_params: np.ndarray = None) -> BatchedFit:
+
+    '''
+        Fits a log link Poisson GLM of every column of Y on the shared design
+        X by iteratively reweighted least squares, with the same deviance
+        convergence rule as statsmodels GLM.fit().
+
+        Long recordings are first fitted on an evenly strided subsample of
+        about warm_start_rows samples, so the full fit starts close to the
+        optimum and converges in 3 to 4 full iterations instead of about 7
+        from the statsmodels start.
+
+        The work of an iteration still grows with the number of units, so
+        the batched fit does not cost a single fit. Measured with
+        python -m benchmarks.bench_batched_glm (40 units, one core): 4.3
+        single statsmodels fits for 90000 samples and 3 params (0.43 s
+        against 0.10 s), 3.3 for 180000 samples and 3 params, and 2.0 for
+        180000 samples and 12 params (1.49 s against 0.74 s). That is 9 to
+        20 times faster than fitting the units one by one.
+
+        Params:
+            X (np.ndarray):
+                n_samples x n_params design matrix (no intercept is added)
+            Y (np.ndarray):
+                n_samples x n_units responses (counts, or rates without
+                exposure). NaN responses are ignored for their unit only.
+                Units without a spike (or without a response) have no
+                maximum likelihood fit, they get NaN params and deviance and
+                are not converged
+            exposure (np.ndarray):
+                Optional bin durations, entering as a log offset
+            max_iter (int):
+                Maximum number of IRLS iterations
+            tol (float):
+                Convergence tolerance on the change of the deviance
+            max_bytes (int):
+                Memory used by the row-wise outer products of X. They are
+                computed once when they fit, in chunks at every iteration
+                otherwise
+            warm_start_rows (int):
+                Size of the subsample fitted first, 0 (or more than the
+                number of samples) to start from the statsmodels start
+            start_params (np.ndarray):
+                Optional n_params x n_units starting params, NaN columns use
+                the default start
+
+        Returns:
+            BatchedFit
+    '''
+
+    X = np.asarray(X, dtype=float).reshape((len(X), -1))
+    Y = np.asarray(Y, dtype=float).reshape((len(Y), -1))
+    n, p = X.shape
+    n_units = Y.shape[1]
+
+    # Samples with a missing covariate or exposure are dropped for every unit
+    keep = ~np.isnan(X).any(axis=1)
+    offset = None
+    if exposure is not None:
+        exposure = np.asarray(exposure, dtype=float).flatten()
+        keep &= ~np.isnan(exposure)
+        offset = np.log(np.where(keep, exposure, 1))[keep, None]
+    if not keep.all():
+        X, Y = X[keep], Y[keep]
+    n = len(X)
+
+    # Missing responses get a zero weight
+    mask = ~np.isnan(Y)
+    complete = mask.all()
+    if not complete:
+        Y = np.where(mask, Y, 0)
+
+    # Row-wise outer products, X'WX of every unit is then W' @ XX. Only the
+    # upper triangle is computed, X'WX is symmetric
+    upper, lower = np.triu_indices(p)
+    n_pairs = len(upper)
+    chunk = max(1, max_bytes // (8 * n_pairs))
+    XX = X[:, upper] * X[:, lower] if chunk >= n else None
+
+    def gram(W):
+        if XX is not None:
+            G = W.T @ XX
+        else:
+            G = np.zeros((W.shape[1], n_pairs))
+            for start in range(0, n, chunk):
+                rows = slice(start, start + chunk)
+                G += W[rows].T @ (X[rows][:, upper] * X[rows][:, lower])
+        A = np.empty((W.shape[1], p, p))
+        A[:, upper, lower] = G
+        A[:, lower, upper] = G
+        return A
+
+    def mean(linear, units):
+        # mu = exp(linear + offset), zero for missing responses
+        mu = np.exp(linear if offset is None else linear + offset)
+        if not complete:
+            mu *= mask[:, units]
+        return mu
+
+    # Per unit constants. With eta = X @ params + offset the Poisson deviance
+    # 2 * sum(y log(y / mu) - (y - mu)) only needs sum(mu) at every iteration
+    ones = np.ones(n)
+    XY = Y.T @ X
+    Y_log_Y = xlogy(Y, Y).sum(axis=0)
+    deviance_constant = Y_log_Y - ones @ Y
+    if offset is not None:
+        deviance_constant -= offset[:, 0] @ Y
+
+    def deviance(params, mu, units):
+        return 2 * (deviance_constant[units] - np.sum(XY[units].T * params, axis=0) + ones @ mu)
+
+    params = np.zeros((p, n_units))
+    fitted_deviance = np.full(n_units, np.nan)
+    converged = np.zeros(n_units, dtype=bool)
+    n_iter = 0
+
+    # Without a spike the likelihood keeps increasing as mu goes to 0, and
+    # the weighted normal equations of the unit become singular
+    degenerate = (ones @ Y == 0) | ~mask.any(axis=0)
+    params[:, degenerate] = np.nan
+    active = np.flatnonzero(~degenerate)
+
+    # Starting params fitted on a subsample, strided so it spans the session
+    if start_params is None and 0 < warm_start_rows <= n // 4 and len(active) > 0:
+        stride = n // warm_start_rows
+        sample = Y[::stride][:, active]
+        if not complete:
+            sample[~mask[::stride][:, active]] = np.nan
+        subsample = fit_poisson_batch(X[::stride], sample, None if offset is None else np.exp(offset[::stride, 0]),
+                                      max_iter, tol, max_bytes, warm_start_rows=0)
+        start_params = np.full((p, n_units), np.nan)
+        start_params[:, active[subsample.converged]] = subsample.params[:, subsample.converged]
+        del sample
+
+    warm = active[:0]
+    if start_params is not None:
+        start_params = np.asarray(start_params, dtype=float).reshape((p, n_units))
+        warm = active[np.isfinite(start_params[:, active]).all(axis=0)]
+        with np.errstate(over='ignore', invalid='ignore'):
+            previous = deviance(start_params[:, warm], mean(X @ start_params[:, warm], warm), warm)
+        # A start too far off to evaluate falls back to the statsmodels start
+        warm, previous = warm[np.isfinite(previous)], previous[np.isfinite(previous)]
+    cold = np.setdiff1d(active, warm)
+
+    # statsmodels start, mu halfway between y and its mean
+    linear = X @ start_params[:, warm] if len(warm) > 0 else np.zeros((n, 0))
+    if len(cold) > 0:
+        Y_cold = Y[:, cold]
+        mu = (Y_cold + (ones @ Y_cold) / np.maximum(mask[:, cold].sum(axis=0), 1)) / 2
+        if not complete:
+            mu *= mask[:, cold]
+        log_mu = np.log(mu, out=np.zeros_like(mu), where=mu > 0)
+        previous = np.append(previous if len(warm) > 0 else [], 
+                             2 * (Y_log_Y[cold] - np.sum(Y_cold * log_mu, axis=0) - ones @ (Y_cold - mu)))
+        linear = np.hstack([linear, log_mu if offset is None else log_mu - offset])
+        del Y_cold, mu, log_mu
+
+    active = np.concatenate([warm, cold])
+    mu = mean(linear, active)
+
+    # The n_samples x n_units work happens in place in linear and mu
+    for n_iter in range(1, max_iter + 1 if len(active) > 0 else 1):
+        # IRLS update, weights W = mu and working response
+        # z = linear + (y - mu) / mu, so W * z = mu * (linear - 1) + y
+        A = gram(mu)
+        linear -= 1
+        linear *= mu
+        b = linear.T @ X + XY[active]
+        update = np.linalg.solve(A, b[:, :, None])[:, :, 0].T
+
+        np.matmul(X, update, out=linear)
+        if offset is None:
+            np.exp(linear, out=mu)
+        else:
+            np.add(linear, offset, out=mu)
+            np.exp(mu, out=mu)
+        if not complete:
+            mu *= mask[:, active]
+        current = deviance(update, mu, active)
+
+        params[:, active] = update
+        fitted_deviance[active] = current
+        done = np.abs(current - previous) <= tol
+        converged[active[done]] = True
+        if done.all():
+            break
+
+        # Units that converged stop iterating
+        if done.any():
+            linear, mu, current = linear[:, ~done], mu[:, ~done], current[~done]
+            active = active[~done]
+        previous = current
+
+    return BatchedFit(params, fitted_deviance, converged, n_iter)
+
+# =========================================================================== #
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+K-fold cross-validation of the GLM families with contiguous time-block folds.
+Firing rates are autocorrelated, so interleaved folds would leak the test
+samples into the training set through their neighbours.
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import statsmodels.api as sm
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from .neuron_functions import GLM_FAMILIES, choose_GLM_model, unsupported_response, fitted_response
+
+# =========================================================================== #
+
+@dataclass
+class CrossValidation:
+
+    '''
+        Held-out scores of a family, summed over the folds.
+
+        loglike is the held-out log-likelihood. pseudo_r2 is the held-out
+        deviance explained, 1 - D(model) / D(null), where the null model is
+        the intercept only model of the same family fit on the same folds.
+
+        The scores are NaN and error holds the reason when a fold failed,
+        the family cannot model the response (see unsupported_response) or
+        a score is not finite.
+    '''
+
+    family: str
+    loglike: float = np.nan
+    pseudo_r2: float = np.nan
+    fold_loglike: list = field(default_factory=list)
+    error: str = None
+
+# =========================================================================== #
+
+def block_folds(n_samples: int, k: int, gap: int = 0) -> list:
+
+    '''
+        Splits samples into k contiguous blocks.
+
+        Params:
+            n_samples (int):
+                Number of samples
+            k (int):
+                Number of folds
+            gap (int):
+                Samples on each side of a test block left out of its
+                training set
+
+        Returns:
+            list: (test_start, test_stop, gap) of every fold
+    '''
+
+    edges = np.linspace(0, n_samples, k + 1).astype(int)
+    return [(int(edges[i]), int(edges[i + 1]), gap) for i in range(k)]
+
+# =========================================================================== #
+
+def split_fold(array: np.ndarray, fold: tuple) -> tuple:
+
+    '''
+        Training and test samples of a fold from block_folds, None for both
+        if array is None.
+    '''
+
+    start, stop, gap = fold
+    if array is None:
+        return None, None
+    train = np.concatenate([array[:max(start - gap, 0)], array[stop + gap:]])
+    return train, np.array(array[start:stop])
+
+# =========================================================================== #
+
+def _held_out(family: str, X: np.ndarray, y: np.ndarray, exposure: np.ndarray, fold: tuple,
+              family_params: dict) -> tuple:
+
+    '''
+        Fits a family and its intercept only null model on the training
+        samples of a fold. Returns the held-out log-likelihood and the
+        held-out deviances of the model and of the null model.
+    '''
+
+    X_train, X_test = split_fold(X, fold)
+    y_train, y_test = split_fold(y, fold)
+    exposure_train, exposure_test = split_fold(exposure, fold)
+
+    scores = []
+    for design_train, design_test in [(X_train, X_test), (np.ones(len(y_train)), np.ones(len(y_test)))]:
+        model = choose_GLM_model(design_train, y_train, family, exposure_train, prepared=True, **family_params)
+        predictor = model.fit()
+
+        # Same conventions as choose_GLM_model: log link families model the
+        # counts through the exposure, other families the rate
+        response = y_test
+        if exposure_test is None:
+            mu = predictor.predict(design_test)
+        elif isinstance(model.family.link, sm.families.links.Log):
+            mu = predictor.predict(design_test, exposure=exposure_test)
+        else:
+            mu = predictor.predict(design_test)
+            response = y_test / exposure_test
+
+        loglike = model.family.loglike(response, mu, scale=predictor.scale)
+        deviance = model.family.deviance(response, mu)
+        scores.append((loglike, deviance))
+
+    (loglike, deviance), (_, null_deviance) = scores
+    return loglike, deviance, null_deviance
+
+# =========================================================================== #
+
+def _held_out_shared(folder: str, family: str, fold: tuple, family_params: dict) -> tuple:
+
+    '''
+        _held_out in a worker process, on arrays memory-mapped from folder.
+    '''
+
+    def load(name):
+        path = os.path.join(folder, name + '.npy')
+        return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+    return _held_out(family, load('X'), load('y'), load('exposure'), fold, family_params)
+
+# =========================================================================== #
+
+def cross_validate(X: np.ndarray, y: np.ndarray, exposure: np.ndarray = None, families: list = None,
+                   k: int = 5, gap: int = 0, workers: int = 1, family_params: dict | None = None) -> list:
+
+    '''
+        Cross-validates GLM families on contiguous time-block folds.
+
+        Params:
+            X, y, exposure (np.ndarray):
+                Model data in time order, see prepare_GLM_data
+            families (list):
+                Keys of GLM_FAMILIES, all of them if None
+            k (int):
+                Number of folds
+            gap (int):
+                Samples on each side of a test block left out of its
+                training set
+            workers (int):
+                Processes fitting the folds in parallel (None for one per
+                core). The arrays are shared with them through memory-mapped
+                files, not pickled for every fold. 1 fits in this process
+            family_params (dict):
+                Passed to the families, see choose_GLM_model, none if None
+
+        Returns:
+            list: CrossValidation of every family
+    '''
+
+    if families is None:
+        families = list(GLM_FAMILIES)
+    family_params = dict(family_params) if family_params is not None else {}
+    folds = block_folds(len(y), k, gap)
+
+    # Families whose likelihood is not defined on the response are not fitted
+    invalid = {}
+    for family in families:
+        try:
+            reason = unsupported_response(family, fitted_response(y, exposure, GLM_FAMILIES[family](**family_params)))
+        except Exception as e:
+            reason = str(e)
+        if reason is not None:
+            invalid[family] = reason
+    tasks = [(family, fold) for family in families if family not in invalid for fold in folds]
+
+    folder = None
+    try:
+        if workers == 1:
+            outcomes = []
+            for family, fold in tasks:
+                try:
+                    outcomes.append(_held_out(family, X, y, exposure, fold, family_params))
+                except Exception as e:
+                    outcomes.append(e)
+        else:
+            folder = tempfile.mkdtemp(prefix='burstfit_cv')
+            for name, array in [('X', X), ('y', y), ('exposure', exposure)]:
+                if array is not None:
+                    np.save(os.path.join(folder, name + '.npy'), np.asarray(array, dtype=float))
+
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_held_out_shared, folder, family, fold, family_params)
+                           for family, fold in tasks]
+                outcomes = []
+                for future in futures:
+                    try:
+                        outcomes.append(future.result())
+                    except Exception as e:
+                        outcomes.append(e)
+    finally:
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    results = []
+    fitted = [family for family in families if family not in invalid]
+    for family in families:
+        if family in invalid:
+            results.append(CrossValidation(family, error=invalid[family]))
+            continue
+
+        i = fitted.index(family)
+        fold_outcomes = outcomes[i * k:(i + 1) * k]
+        errors = [outcome for outcome in fold_outcomes if isinstance(outcome, Exception)]
+        if len(errors) > 0:
+            results.append(CrossValidation(family, error=str(errors[0])))
+            continue
+
+        loglike, deviance, null_deviance = np.array(fold_outcomes).T
+        loglike_sum, pseudo_r2 = float(loglike.sum()), float(1 - deviance.sum() / null_deviance.sum())
+        if not (np.isfinite(loglike_sum) and np.isfinite(pseudo_r2)):
+            results.append(CrossValidation(family, fold_loglike=list(loglike), 
+                                           error='Non-finite held-out log-likelihood or deviance'))
+            continue
+        results.append(CrossValidation(family, loglike_sum, pseudo_r2, list(loglike)))
+
+    return results
+
+# =========================================================================== #
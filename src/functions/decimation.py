@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Level of detail decimation of long traces for plotting. A trace drawn with
+more than a couple of points per pixel column looks the same as its min/max
+envelope, so only the extremes of every pixel column need to be drawn.
+"""
+
+import numpy as np
+
+# =========================================================================== #
+
+class DecimationPyramid:
+
+    '''
+        Min/max decimation pyramid of a trace y(x) with sorted x. Level l
+        holds the indices of the minimum and maximum sample of every bucket
+        of 2**l consecutive samples, built from level l - 1 by comparing
+        pairs of buckets. The pyramid takes about twice the memory of the
+        trace indices and is built in O(n).
+
+        Params:
+            x (np.ndarray):
+                Sorted sample positions, e.g. time
+            y (np.ndarray):
+                Sample values, NaN values are never chosen as extremes
+                unless a whole bucket is NaN
+    '''
+
+    def __init__(self, x: np.ndarray, y: np.ndarray):
+
+        self.x = np.asarray(x, dtype=float).flatten()
+        self.y = np.asarray(y, dtype=float).flatten()
+
+        # NaN samples lose both comparisons
+        low = np.where(np.isnan(self.y), np.inf, self.y)
+        high = np.where(np.isnan(self.y), -np.inf, self.y)
+
+        index = np.arange(len(self.y))
+        self.levels = [(index, index)]
+        while len(self.levels[-1][0]) > 1:
+            self.levels.append(self._reduce(*self.levels[-1], low, high))
+
+    # ------------------------------------------- #
+
+    @staticmethod
+    def _reduce(minimum: np.ndarray, maximum: np.ndarray, low: np.ndarray, high: np.ndarray) -> tuple:
+
+        # An odd bucket count pairs the last bucket with itself
+        if len(minimum) % 2 == 1:
+            minimum = np.append(minimum, minimum[-1])
+            maximum = np.append(maximum, maximum[-1])
+
+        first, second = minimum[0::2], minimum[1::2]
+        minimum = np.where(low[second] < low[first], second, first)
+        first, second = maximum[0::2], maximum[1::2]
+        maximum = np.where(high[second] > high[first], second, first)
+
+        return minimum, maximum
+
+    # ------------------------------------------- #
+
+    def view(self, x_min: float = None, x_max: float = None, n_points: int = 2000) -> tuple:
+
+        '''
+            Decimated trace over [x_min, x_max] (the whole trace if None),
+            plus one neighbour on each side so lines reach the edges of the
+            view. Buckets are powers of two samples, so between n_points and
+            2 * n_points points are drawn: at least the extremes of every
+            pixel column for n_points of twice the view width in pixels.
+
+            Returns:
+                Tuple: x, y of the samples to draw, in x order
+        '''
+
+        n = len(self.x)
+        start = 0 if x_min is None else max(int(np.searchsorted(self.x, x_min, 'left')) - 1, 0)
+        stop = n if x_max is None else min(int(np.searchsorted(self.x, x_max, 'right')) + 1, n)
+        if stop - start <= n_points:
+            return self.x[start:stop], self.y[start:stop]
+
+        # Coarsest level keeping at least n_points / 2 buckets, two points each
+        level = min(int(np.log2((stop - start) / max(n_points // 2, 1))), len(self.levels) - 1)
+        size = 2 ** level
+        minimum, maximum = self.levels[level]
+
+        # Buckets cut by the edges of the view are drawn in full detail
+        first, last = -(-start // size), max(stop // size, -(-start // size))
+        if stop == n:
+            last = len(minimum)
+        indices = np.concatenate([[start, stop - 1], np.arange(start, min(first * size, stop)),
+                                  minimum[first:last], maximum[first:last],
+                                  np.arange(max(last * size, start), stop)])
+        indices = np.unique(indices)
+
+        return self.x[indices], self.y[indices]
+
+# =========================================================================== #
+
+def pixel_thin(x: np.ndarray, y: np.ndarray, x_range: tuple, y_range: tuple, width: int,
+               height: int) -> np.ndarray:
+
+    '''
+        Indices of the scatter points to draw: one point of every occupied
+        pixel of a width x height view of x_range x y_range. Points outside
+        the view and NaN points are dropped.
+    '''
+
+    x = np.asarray(x, dtype=float).flatten()
+    y = np.asarray(y, dtype=float).flatten()
+    (x_min, x_max), (y_min, y_max) = x_range, y_range
+
+    visible = np.flatnonzero((x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max))
+    column = ((x[visible] - x_min) / ((x_max - x_min) or 1) * (width - 1)).astype(np.int64)
+    row = ((y[visible] - y_min) / ((y_max - y_min) or 1) * (height - 1)).astype(np.int64)
+
+    _, first = np.unique(row * width + column, return_index=True)
+
+    return visible[np.sort(first)]
+
+# =========================================================================== #
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-covariate GLM design matrices built from the position data of a session.
+Covariate blocks (and their basis expansions) only depend on the session, so
+they are built once and shared by every cell.
+"""
+
+import weakref
+import numpy as np
+from scipy.interpolate import BSpline
+
+# =========================================================================== #
+
+def bspline_basis(x: np.ndarray, n_basis: int, degree: int = 3, drop_first: bool = True) -> np.ndarray:
+
+    '''
+        B-spline basis with interior knots at quantiles of x. Tied values
+        (e.g. zero speed at rest, integer pixel positions) can put several
+        quantiles on the same value, which would leave basis functions
+        without support. The knots are then evenly spaced instead.
+
+        Params:
+            x (np.ndarray):
+                Covariate values, NaN values give NaN rows
+            n_basis (int):
+                Number of basis functions, at least degree + 1
+            degree (int):
+                Spline degree, 3 for cubic splines
+            drop_first (bool):
+                B-splines sum to one, the first column is dropped so the
+                basis is not collinear with an intercept
+
+        Returns:
+            np.ndarray:
+                len(x) x n_basis (n_basis - 1 if drop_first) basis matrix
+    '''
+
+    x = np.asarray(x, dtype=float).flatten()
+    valid = ~np.isnan(x)
+
+    # Clamped knot vector, interior knots follow the distribution of x
+    n_interior = n_basis - degree - 1
+    interior = np.quantile(x[valid], np.linspace(0, 1, n_interior + 2)[1:-1])
+    low, high = x[valid].min(), x[valid].max()
+    distinct = np.unique(interior)
+    if len(distinct[(distinct > low) & (distinct < high)]) < n_interior:
+        interior = np.linspace(low, high, n_interior + 2)[1:-1]
+    knots = np.concatenate([np.repeat(low, degree + 1), interior, np.repeat(high, degree + 1)])
+
+    basis = np.full((len(x), n_basis), np.nan)
+    basis[valid] = BSpline.design_matrix(x[valid], knots, degree).toarray()
+
+    return basis[:, 1:] if drop_first else basis
+
+# =========================================================================== #
+
+def cosine_basis(x: np.ndarray, n_basis: int, period: float = None, drop_first: bool = True) -> np.ndarray:
+
+    '''
+        Raised cosine bumps with evenly spaced centres, each bump spanning two
+        centre spacings so neighbouring bumps overlap by half.
+
+        Params:
+            x (np.ndarray):
+                Covariate values, NaN values give NaN rows
+            n_basis (int):
+                Number of bumps
+            period (float):
+                Period of a circular covariate (2*pi for angles). Bumps then
+                wrap around and are centred over [0, period). None for a
+                linear covariate, bumps are centred over [min(x), max(x)]
+            drop_first (bool):
+                The bumps sum to one, the first column is dropped so the
+                basis is not collinear with an intercept
+
+        Returns:
+            np.ndarray:
+                len(x) x n_basis (n_basis - 1 if drop_first) basis matrix
+    '''
+
+    x = np.asarray(x, dtype=float).flatten()
+
+    if period is None:
+        centres = np.linspace(np.nanmin(x), np.nanmax(x), n_basis)
+        distance = x[:, None] - centres[None, :]
+    else:
+        centres = np.arange(n_basis) * (period / n_basis)
+        distance = x[:, None] - centres[None, :]
+        distance = (distance + period / 2) % period - period / 2
+
+    spacing = centres[1] - centres[0]
+    phase = np.clip(distance / (2 * spacing), -0.5, 0.5)
+    basis = 0.5 * (1 + np.cos(2 * np.pi * phase))
+
+    return basis[:, 1:] if drop_first else basis
+
+# =========================================================================== #
+
+def tensor_basis(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+
+    '''
+        Row-wise tensor product of two bases, e.g. a 2-D position spline from
+        the x and y spline bases.
+    '''
+
+    return np.einsum('ni,nj->nij', first, second).reshape((len(first), -1))
+
+# =========================================================================== #
+
+def movement_direction(pos_x: np.ndarray, pos_y: np.ndarray) -> np.ndarray:
+
+    '''
+        Direction of movement in radians [0, 2*pi) between consecutive
+        position samples. Samples without movement keep the previous
+        direction, samples before the first movement are NaN. This is not
+        the head direction (see getheaddir): the animal can face away from
+        where it moves, and only the first LED is used.
+    '''
+
+    dx = np.diff(np.asarray(pos_x, dtype=float).flatten())
+    dy = np.diff(np.asarray(pos_y, dtype=float).flatten())
+    moving = (dx != 0) | (dy != 0)
+
+    direction = np.mod(np.arctan2(dy, dx), 2 * np.pi)
+    direction = np.append(direction[:1], direction)
+    moving = np.append(moving[:1], moving)
+
+    # Forward fill the direction of the last moving sample, no direction yet
+    # before the first movement
+    direction[~moving] = np.nan
+    last_moving = np.maximum.accumulate(np.where(moving, np.arange(len(moving)), 0))
+
+    return direction[last_moving]
+
+# =========================================================================== #
+
+def _linear(values: np.ndarray, name: str) -> tuple:
+    return values.reshape((-1, 1)), [name]
+
+def _spline(values: np.ndarray, name: str, n_basis: int = 8, degree: int = 3) -> tuple:
+    basis = bspline_basis(values, n_basis, degree)
+    return basis, ['%s_spline%d' % (name, i) for i in range(basis.shape[1])]
+
+# Covariate blocks, each built from (pos_x, pos_y, pos_t, speed,
+# movement_direction, head_direction) and optional parameters. Returns the block and the names
+# of its columns.
+COVARIATES = {
+    'intercept': lambda s: (np.ones((len(s['pos_t']), 1)), ['intercept']),
+    'time': lambda s: _linear(s['pos_t'], 'time'),
+    'speed': lambda s: _linear(s['speed'], 'speed'),
+    'position': lambda s: (np.column_stack([s['pos_x'], s['pos_y']]), ['x', 'y']),
+    'movement_direction': lambda s: (np.column_stack([np.cos(s['movement_direction']),
+                                                      np.sin(s['movement_direction'])]),
+                                     ['cos_movement_direction', 'sin_movement_direction']),
+    'head_direction': lambda s: (np.column_stack([np.cos(s['head_direction']), np.sin(s['head_direction'])]),
+                                 ['cos_head_direction', 'sin_head_direction']),
+    'time_spline': lambda s, **p: _spline(s['pos_t'], 'time', **p),
+    'speed_spline': lambda s, **p: _spline(s['speed'], 'speed', **p),
+    'speed_cosine': lambda s, n_basis=8: (cosine_basis(s['speed'], n_basis),
+                                          ['speed_cosine%d' % i for i in range(n_basis - 1)]),
+    'movement_direction_cosine': lambda s, n_basis=8: (
+        cosine_basis(s['movement_direction'], n_basis, period=2 * np.pi),
+        ['movement_direction_cosine%d' % i for i in range(n_basis - 1)]),
+    'head_direction_cosine': lambda s, n_basis=8: (
+        cosine_basis(s['head_direction'], n_basis, period=2 * np.pi),
+        ['head_direction_cosine%d' % i for i in range(n_basis - 1)]),
+    'position_spline': lambda s, n_basis=6, degree=3: (
+        tensor_basis(bspline_basis(s['pos_x'], n_basis, degree, drop_first=False),
+                     bspline_basis(s['pos_y'], n_basis, degree, drop_first=False))[:, 1:],
+        ['position_spline%d' % i for i in range(n_basis * n_basis - 1)]),
+}
+
+# =========================================================================== #
+
+class DesignMatrix:
+
+    '''
+        Builds design matrices from named covariate blocks of a session.
+        Blocks and assembled matrices are cached, use for_session to share
+        them between every pipeline working on the same loaded session.
+
+        A block is given by its name in COVARIATES, or a (name, params) tuple
+        for blocks with parameters, e.g. ('speed_spline', {'n_basis': 10}).
+
+        Params:
+            cell_data (tuple):
+                Loaded session, see GLMPipeline.load
+    '''
+
+    _sessions = weakref.WeakKeyDictionary()
+
+    def __init__(self, cell_data: tuple):
+
+        pos_x, pos_y, pos_t = cell_data[1][0], cell_data[1][1], cell_data[1][2]
+        self.session = {
+            'pos_x': np.asarray(pos_x, dtype=float).flatten(),
+            'pos_y': np.asarray(pos_y, dtype=float).flatten(),
+            'pos_t': np.asarray(pos_t, dtype=float).flatten(),
+            'speed': np.asarray(cell_data[3], dtype=float).flatten(),
+            'movement_direction': movement_direction(pos_x, pos_y),
+            'head_direction': np.asarray(cell_data[1][5], dtype=float).flatten(),
+        }
+        self._blocks = {}
+        self._matrices = {}
+
+    # ------------------------------------------- #
+
+    @classmethod
+    def for_session(cls, cell_data: tuple):
+
+        '''
+            The design matrix builder of a loaded session, created on first use.
+        '''
+
+        # Keyed by the spike index, which lives as long as the loaded session
+        design = cls._sessions.get(cell_data[0])
+        if design is None:
+            design = cls._sessions[cell_data[0]] = cls(cell_data)
+        return design
+
+    # ------------------------------------------- #
+
+    @staticmethod
+    def _key(spec) -> tuple:
+        if isinstance(spec, str):
+            return (spec, ())
+        name, params = spec
+        return (name, tuple(sorted(params.items())))
+
+    # ------------------------------------------- #
+
+    def block(self, spec) -> tuple:
+
+        '''
+            Returns a covariate block and the names of its columns.
+        '''
+
+        key = self._key(spec)
+        if key not in self._blocks:
+            name, params = key
+            if name not in COVARIATES:
+                raise ValueError("Unknown covariate '%s', available: %s" % (name, ', '.join(COVARIATES)))
+            self._blocks[key] = COVARIATES[name](self.session, **dict(params))
+        return self._blocks[key]
+
+    # ------------------------------------------- #
+
+    def build(self, specs: list) -> tuple:
+
+        '''
+            Assembles the design matrix of the given covariate blocks.
+
+            Returns:
+                Tuple: X, names
+                --------
+                X (np.ndarray):
+                    One row per position sample, NaN where a covariate is
+                    missing (dropped by prepare_GLM_data)
+                names (list):
+                    Name of every column
+        '''
+
+        key = tuple(self._key(spec) for spec in specs)
+        if key not in self._matrices:
+            blocks = [self.block(spec) for spec in specs]
+            X = np.hstack([block for block, _ in blocks])
+            names = [name for _, block_names in blocks for name in block_names]
+            self._matrices[key] = (X, names)
+        return self._matrices[key]
+
+# =========================================================================== #
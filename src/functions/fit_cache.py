@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory cache of fitted GLM results, so that a combination of session, 
+cell, family and graph type that was already viewed is not refit.
+"""
+
+import os
+import numpy as np
+from collections import OrderedDict
+
+# =========================================================================== #
+
+def file_identity(path: str) -> tuple: 
+    
+    '''
+        Identifies a file by its absolute path, size and modification time, 
+        so that any change to the file gives it a new identity. 
+        
+        Params: 
+            path (str): 
+                Path of the file 
+
+        Returns: 
+            Tuple: (absolute_path, size, mtime_ns), or None if path is None 
+            or the file does not exist, so the job reports the missing file
+    '''
+    
+    if path is None or not os.path.isfile(path):
+        return None
+    
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+# =========================================================================== #
+
+class FitCache: 
+    
+    '''
+        Bounded cache of fitted results (x, y, prediction, params, deviance). 
+        Once the arrays held exceed max_bytes, the least recently used 
+        results are evicted first. 
+    '''
+    
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()       # key -> (result, size in bytes)
+        
+    # ------------------------------------------- #  
+    
+    @staticmethod
+    def make_key(files: list, ppm: int, cell: int, family: str, graph: str, **options) -> tuple: 
+        
+        '''
+            Builds the cache key of a fit. Files are identified by path, size 
+            and modification time. Extra options (e.g. binning) must be hashable.
+        '''
+        
+        return (tuple(file_identity(file) for file in files), ppm, cell, family, graph, 
+                tuple(sorted(options.items())))
+    
+    # ------------------------------------------- #  
+    
+    def get(self, key: tuple): 
+        
+        '''
+            Returns the cached result for key (marking it as most recently 
+            used), or None if it is not cached.
+        '''
+        
+        if key not in self._entries:
+            return None
+        
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+    
+    # ------------------------------------------- #  
+    
+    def put(self, key: tuple, result: tuple) -> None: 
+        
+        '''
+            Caches a result and evicts the least recently used ones until the 
+            cache fits in max_bytes. Results larger than max_bytes are not cached.
+        '''
+        
+        size = sum(np.asarray(value).nbytes for value in result)
+        if size > self.max_bytes:
+            return
+        
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+            
+        self._entries[key] = (result, size)
+        self.nbytes += size
+        
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_size
+            
+    # ------------------------------------------- #  
+    
+    def clear(self) -> None: 
+        self._entries.clear()
+        self.nbytes = 0
+        
+    def __contains__(self, key: tuple):
+        return key in self._entries
+    
+    def __len__(self):
+        return len(self._entries)
+    
+# =========================================================================== #
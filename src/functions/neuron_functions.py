@@ -10,18 +10,132 @@ import scipy
 import numpy as np
 import statsmodels.api as sm
 from matplotlib import pyplot as plt
-from .Tint_Matlab import read_cut, getspikes, getpos, centerBox, remBadTrack
+from .Tint_Matlab import load_cut_labels, is_clu_file, getspiketimes, spike_records, getpos, getheaddir, centerBox, remBadTrack, badTrackMask, nearest_sample
 
 
 # =========================================================================== #
+
+class UnitSpikeIndex: 
+    
+    '''
+        Compact (CSR-style) index of the spikes of every unit on a tetrode.
+        Spikes are sorted once by their cut label, so the spikes of unit u 
+        occupy the contiguous range offsets[u]:offsets[u+1] of the sorted 
+        arrays. The sort is stable, so each unit's spikes stay in time order. 
+        Waveforms are decoded lazily, one channel at a time, the first time 
+        they are requested.
+    '''
+    
+    def __init__(self, order: np.ndarray, offsets: np.ndarray, times: np.ndarray, 
+                 tetrode_path: str = None, channel_no: int = 1):
+        
+        self.order = order                  # Sorted position -> spike number in the tetrode file
+        self.offsets = offsets              # Start of each unit in the sorted arrays (length units + 1)
+        self.times = times                  # Spike times, sorted by unit
+        self.tetrode_path = tetrode_path
+        self.channel_no = channel_no
+        self._waveforms = {}                # Decoded waveforms (sorted by unit) per channel
+        
+    # ------------------------------------------- #  
+    
+    @classmethod
+    def from_cut(cls, cut_data: np.ndarray, spike_times: np.ndarray, 
+                 tetrode_path: str = None, channel_no: int = 1):
+        
+        '''
+            Builds the index from the cut label and time of every spike.
+        '''
+        
+        cut_data = np.asarray(cut_data)
+        order = np.argsort(cut_data, kind='stable')
+        offsets = np.zeros(int(cut_data.max()) + 2 if len(cut_data) else 1, dtype=np.int64)
+        np.cumsum(np.bincount(cut_data), out=offsets[1:])
+        times = np.asarray(spike_times).flatten()[order]
+        
+        return cls(order, offsets, times, tetrode_path, channel_no)
+    
+    # ------------------------------------------- #  
+    
+    @property
+    def counts(self) -> np.ndarray: 
+        
+        '''
+            Number of spikes per unit
+        '''
+        
+        return np.diff(self.offsets)
+    
+    # ------------------------------------------- #  
+    
+    @property
+    def empty_cell(self) -> int: 
+        
+        '''
+            The first unit (after the unit 0 noise cluster) without spikes, 
+            which separates the good cells from the rest in Tint. If there is 
+            no gap, the last unit. 
+        '''
+        
+        empty_cells = np.flatnonzero(self.counts[1:] == 0)
+        if len(empty_cells) > 0:
+            return int(empty_cells[0]) + 1
+        return len(self) - 1
+    
+    # ------------------------------------------- #  
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    # ------------------------------------------- #  
+    
+    def times_for(self, unit: int) -> np.ndarray: 
+        
+        '''
+            Spike times of a unit (a view into the sorted time array)
+        '''
+        
+        return self.times[self.offsets[unit]:self.offsets[unit + 1]]
+    
+    # ------------------------------------------- #  
+    
+    def waveforms_for(self, unit: int, channel_no: int = None) -> np.ndarray: 
+        
+        '''
+            Waveforms (spikes x samples) of a unit on a given channel. The 
+            first request for a channel decodes it for all spikes at once.
+        '''
+        
+        if channel_no is None:
+            channel_no = self.channel_no
+            
+        if channel_no not in self._waveforms:
+            records, _ = spike_records(self.tetrode_path)
+            self._waveforms[channel_no] = records['ch%d' % channel_no][self.order]
+            
+        return self._waveforms[channel_no][self.offsets[unit]:self.offsets[unit + 1]]
+    
+    # ------------------------------------------- #  
+    
+    def spikes_for(self, unit: int) -> tuple: 
+        
+        '''
+            Spike times and waveforms (default channel) of a unit
+        '''
+        
+        return self.times_for(unit), self.waveforms_for(unit)
+    
+# =========================================================================== #
+
 def load_neurons(cut_path: str, tetrode_path: str, channel_no: int) -> tuple: 
     
     '''
-        Loads the neuron of interest from a specific cut file. 
+        Loads the neuron of interest from a specific cut file. Only the spike 
+        timestamps are read from the tetrode file, waveforms are decoded lazily
+        the first time they are accessed. 
         
         Params: 
             cut_path (str): 
-                The path of the cut file 
+                The path of the cut (or .clu.N) file 
             tetrode_path (str): 
                 The path of the tetrode file 
             channel_no (int): 
@@ -30,34 +144,23 @@ def load_neurons(cut_path: str, tetrode_path: str, channel_no: int) -> tuple:
         Returns: 
             Tuple: (channel_data, empty_cell_number) 
             --------
-            channel_data (list): 
-                Nested list of all the firing data per neuron
+            channel_data (UnitSpikeIndex): 
+                Index of the spike times and waveforms of every neuron
             empty_cell_number (int): 
                 The 'gap' cell which indicates where the program should stop 
                 reading cells from Tint. 
     '''
     
-    # Read cut and tetrode data
-    cut_data = read_cut(cut_path)
-    tetrode_data = getspikes(tetrode_path)
-    number_of_neurons = max(cut_data) + 1
+    # Read cut data (checked against the number of spikes) and spike times
+    cut_data = load_cut_labels(cut_path, tetrode_path)
+    spike_times, _ = getspiketimes(tetrode_path)
     
-    # Organize neuron data into list
-    channel = [[[] for x in range(2)]for x in range(number_of_neurons)]
-    
-    for i in range(len(tetrode_data[0])): 
-        channel[ cut_data[i] ][0].append(tetrode_data[channel_no][i])
-        channel[ cut_data[i] ][1].append(float(tetrode_data[0][i])) 
+    # Organize neuron data into a per unit index
+    channel = UnitSpikeIndex.from_cut(cut_data, spike_times, tetrode_path, channel_no)
     
     # Find where there is a break in the neuron data
     # and assign the empty space number as the empty cell
-    for i, element in enumerate(channel):
-        if (len(element[0]) == 0 or len(element[1]) == 0) and i != 0:
-            empty_cell = i
-            break
-        else:
-            empty_cell = i
-     
+    empty_cell = channel.empty_cell
     
     return channel, empty_cell
 # =========================================================================== #
@@ -94,6 +197,8 @@ def grab_terode_cut_position_files(paths: list) -> tuple:
         for file in files:
             if file[-3:] == 'pos': 
                 pos_files.append(paths[0] + "/" + file)
+            elif is_clu_file(file): 
+                cut_files.append(paths[0] + "/" + file)
             elif file[-1:].isdigit():
                 tetrode_files.append(paths[0] + "/" + file)
             elif file[-3:] == 'cut': 
@@ -102,6 +207,8 @@ def grab_terode_cut_position_files(paths: list) -> tuple:
         for file in paths: 
             if file[-3:] == 'pos': 
                 pos_files.append(file)
+            elif is_clu_file(file): 
+                cut_files.append(file)
             elif file[-1:].isdigit():
                 tetrode_files.append(file)
             elif file[-3:] == 'cut': 
@@ -143,74 +250,203 @@ def get_firing_rate_vs_time(times: np.ndarray, pos_t: np.ndarray, window: int) -
                 Timestamps of when firing occured
         '''
  
-    # Initialize zero time elapsed, zero spike events, and zero bin times.
-    time_elapsed = 0
-    number_of_elements = 1
-    bin_time = [0,0]
-
-    # Initialzie empty firing rate and firing time arrays
-    firing_rate = [0]
-    firing_time = [0]
-
-    # Collect firing data in bins of 400ms
-    for i in range(1, len(times)): 
-        if time_elapsed == 0: 
-            # Set a bin start time
-            bin_time_start = times[i-1]
-
-        # Increment time elapsed and spike number as spike event times are iterated over
-        time_elapsed += (times[i] - times[i-1])
-        number_of_elements += 1
-
-        # If the elapsed time exceeds 400ms
-        if time_elapsed > (window/1000): 
-            # Set bin end time
-            bin_time_end = bin_time_start + time_elapsed
-            # Compute rate, and add element to firing_rate array
-            firing_rate.append(number_of_elements/time_elapsed)
-            firing_time.append( (bin_time_start + bin_time_end)/2 )
-            # Reset elapsed time and spiek events number
-            time_elapsed = 0
-            number_of_elements = 0
+    times = np.asarray(times, dtype=float).flatten()
+    window = window / 1000
 
+    # A bin starts at a spike and closes at the first spike more than one
+    # window later. That spike then starts the next bin. 
+    bin_edges = [0]
+    if len(times) > 1:
+        # For every spike, index of the first spike that would close its bin
+        closing_spike = np.searchsorted(times, times + window, side='right')
+        while closing_spike[bin_edges[-1]] < len(times):
+            bin_edges.append(closing_spike[bin_edges[-1]])
+    bin_edges = np.asarray(bin_edges)
     
+    # Spike count per bin (the very first spike is also counted in the first bin)
+    number_of_elements = np.diff(bin_edges)
+    number_of_elements[:1] += 1
+    bin_time_start = times[bin_edges[:-1]]
+    bin_time_end = times[bin_edges[1:]]
     
+    # Compute rates, first element is a zero rate at time zero
+    firing_rate = np.concatenate(([0], number_of_elements / (bin_time_end - bin_time_start)))
+    firing_time = np.concatenate(([0], (bin_time_start + bin_time_end) / 2))
+    
+    # Place each rate at the position sample closest to its bin center
     rate_vector = np.zeros((len(pos_t), 1))
-    index_values = []
-    for i in range(len(firing_time)):
-        index_values.append(  (np.abs(pos_t - firing_time[i])).argmin()  )
-        
-    firing_rate = np.array(firing_rate).reshape((len(firing_rate), 1))
-    rate_vector[index_values] = firing_rate
-    firing_rate = np.array(firing_rate).reshape((len(firing_rate), 1))
-    rate_vector[index_values] = firing_rate
+    index_values = nearest_sample(pos_t, firing_time)
+    rate_vector[index_values] = firing_rate.reshape((len(firing_rate), 1))
 
     return rate_vector, firing_time
   
 # =========================================================================== #
 
-def choose_GLM_model(x: np.array, y: np.array, family: str):
-    
-    # Instantiate models
-    poisson_model = sm.GLM(y, x, family=sm.families.Poisson(), missing='drop')
-    binomial_model = sm.GLM(y, x, family=sm.families.Binomial(), missing='drop')
-    gamma_model = sm.GLM(y, x, family=sm.families.Gamma(), missing='drop')
-    gaussian_model = sm.GLM(y, x, family=sm.families.Gaussian(), missing='drop')
-    inv_gaussian_model = sm.GLM(y, x, family=sm.families.InverseGaussian(), missing='drop')
-    neg_binomial_model = sm.GLM(y, x, family=sm.families.NegativeBinomial(), missing='drop')
-    tweedie_model = sm.GLM(y, x, family=sm.families.Tweedie(), missing='drop')
-    
-    switcher = {
-        'Poisson': poisson_model,
-        'Binomial': binomial_model,
-        'Negative Binomial': neg_binomial_model,
-        'Gamma': gamma_model,
-        'Gaussian': gaussian_model,
-        'Inverse Gaussian': inv_gaussian_model,
-        'Tweedie': tweedie_model
-    }
-    
-    return switcher[family]
+def get_spike_counts_vs_time(times: np.ndarray, pos_t: np.ndarray, bin_edges: np.ndarray = None) -> tuple: 
+
+    '''
+        Counts spikes on a fixed time grid. Unlike get_firing_rate_vs_time, 
+        every bin has a known duration, so the counts can be modelled directly 
+        with a count GLM using the bin duration as the exposure. 
+
+        Params: 
+            times (np.ndarray): 
+                Array of timestamps of when the neuron fired
+            pos_t (np.ndarray):
+                Time array of entire experiment 
+            bin_edges (np.ndarray): 
+                Optional edges of the time bins. By default there is one bin 
+                per position sample, centered on that sample. 
+
+        Returns: 
+            tuple: spike_counts, exposure
+            --------
+            spike_counts (np.ndarray): 
+                Column array of the number of spikes in each bin
+            exposure: (np.ndarray): 
+                Duration of each bin in seconds
+        '''
+    
+    times = np.asarray(times, dtype=float).flatten()
+    
+    if bin_edges is None: 
+        # Bin edges halfway between position samples, the first and last 
+        # bins extend half a sample interval beyond the recording
+        pos_t = np.asarray(pos_t, dtype=float).flatten()
+        half_interval = np.median(np.diff(pos_t)) / 2
+        bin_edges = np.concatenate(([pos_t[0] - half_interval], 
+                                    (pos_t[1:] + pos_t[:-1]) / 2, 
+                                    [pos_t[-1] + half_interval]))
+    
+    # Count spikes per (half open) bin, dropping spikes outside the grid
+    number_of_bins = len(bin_edges) - 1
+    bin_index = np.searchsorted(bin_edges, times, side='right') - 1
+    bin_index = bin_index[(bin_index >= 0) & (bin_index < number_of_bins)]
+    spike_counts = np.bincount(bin_index, minlength=number_of_bins)
+    
+    return spike_counts.reshape((number_of_bins, 1)), np.diff(bin_edges)
+
+# =========================================================================== #
+
+# Families available in choose_GLM_model, only the requested one is instantiated
+GLM_FAMILIES = {
+    'Poisson': sm.families.Poisson,
+    'Binomial': sm.families.Binomial,
+    'Negative Binomial': sm.families.NegativeBinomial,
+    'Gamma': sm.families.Gamma,
+    'Gaussian': sm.families.Gaussian,
+    'Inverse Gaussian': sm.families.InverseGaussian,
+    'Tweedie': sm.families.Tweedie
+}
+
+# =========================================================================== #
+
+def unsupported_response(family: str, response: np.ndarray) -> str: 
+    
+    '''
+        Why a family cannot model a response, None if it can. Such fits may 
+        still run, but their likelihood is not defined (e.g. infinite) and 
+        must not be scored. 
+        
+        Params: 
+            family (str): 
+                One of the keys of GLM_FAMILIES
+            response (np.ndarray): 
+                The response the family is fit on, counts or rate (see 
+                choose_GLM_model)
+    '''
+    
+    response = np.asarray(response, dtype=float)
+    if family == 'Binomial' and ((response < 0) | (response > 1)).any():
+        return 'Binomial needs responses in [0, 1]'
+    if family in ['Gamma', 'Inverse Gaussian'] and (response <= 0).any():
+        return '%s needs positive responses' % family
+    return None
+
+# =========================================================================== #
+
+def fitted_response(y: np.ndarray, exposure: np.ndarray, model_family) -> np.ndarray: 
+    
+    '''
+        The response a family is fit on by choose_GLM_model: the counts y 
+        for log link families with an exposure, the rate y / exposure for 
+        other families. 
+    '''
+    
+    y = np.asarray(y, dtype=float).flatten()
+    if exposure is None or isinstance(model_family.link, sm.families.links.Log):
+        return y
+    return y / np.asarray(exposure, dtype=float).flatten()
+
+# =========================================================================== #
+
+def prepare_GLM_data(x: np.ndarray, y: np.ndarray, exposure: np.ndarray = None) -> tuple: 
+    
+    '''
+        Drops the observations with a missing (NaN) regressor, response or 
+        exposure. The result is family independent, so it can be computed 
+        once and shared by every model fit on the same data. 
+        
+        Params: 
+            x (np.ndarray): 
+                Regressor(s), one row per observation
+            y (np.ndarray): 
+                Response
+            exposure (np.ndarray): 
+                Optional bin durations
+
+        Returns: 
+            Tuple: x, y, exposure
+            --------
+            x, y, exposure (np.ndarray): 
+                The same arrays without the missing observations 
+                (exposure stays None if it was not given)
+    '''
+    
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    
+    keep = ~np.isnan(y) & ~np.isnan(x.reshape((len(x), -1))).any(axis=1)
+    if exposure is not None:
+        keep &= ~np.isnan(exposure)
+        exposure = np.asarray(exposure)[keep]
+    
+    return x[keep], y[keep], exposure
+
+# =========================================================================== #
+
+def choose_GLM_model(x: np.array, y: np.array, family: str, exposure: np.ndarray = None, 
+                     prepared: bool = False, **family_params):
+    
+    '''
+        Builds the GLM of the chosen family. 
+        
+        If an exposure (bin duration) is given, it enters log link families 
+        (Poisson, Negative Binomial, Tweedie) as a log offset so y is modelled 
+        as counts. Families with other links are fit on the rate y / exposure.
+        
+        Params: 
+            x, y, exposure (np.ndarray): 
+                Model data, see prepare_GLM_data
+            family (str): 
+                One of the keys of GLM_FAMILIES
+            prepared (bool): 
+                True if x, y and exposure already went through 
+                prepare_GLM_data, which is then skipped
+            **family_params: 
+                Passed to the family, e.g. var_power for Tweedie or alpha 
+                for Negative Binomial
+    '''
+    
+    if not prepared:
+        x, y, exposure = prepare_GLM_data(x, y, exposure)
+    
+    model_family = GLM_FAMILIES[family](**family_params)
+    
+    if exposure is not None and not isinstance(model_family.link, sm.families.links.Log):
+        return sm.GLM(y / exposure, x, family=model_family)
+    
+    return sm.GLM(y, x, family=model_family, exposure=exposure)
 
 # =========================================================================== #
     
@@ -226,7 +462,7 @@ def grab_position_data(pos_path: str, ppm: int) -> tuple:
                 Pixel per meter value 
 
         Returns: 
-            Tuple: pos_x,pos_y,pos_t,(pos_x_width,pos_y_width)
+            Tuple: pos_x,pos_y,pos_t,(pos_x_width,pos_y_width),(complete_t,keep),pos_hd
             --------
             pos_x, pos_y, pos_t (np.ndarray): 
                 Array of x, y coordinates, and timestamps 
@@ -234,6 +470,14 @@ def grab_position_data(pos_path: str, ppm: int) -> tuple:
                 max - min x coordinate value (arena width)
             pos_y_width (float) 
                 max - min y coordinate value (arena length)
+            complete_t, keep (np.ndarray): 
+                Timestamps of every sample of the file and the mask of the 
+                samples kept (bad tracking and NaN removed), pos_t is 
+                complete_t[keep]. Passed to spikePos to align spikes 
+                without recomputing the mask
+            pos_hd (np.ndarray): 
+                Head direction in radians of every kept sample, NaN where 
+                an LED is missing (see getheaddir)
     '''
 
     pos_data = getpos(pos_path, ppm)
@@ -257,7 +501,9 @@ def grab_position_data(pos_path: str, ppm: int) -> tuple:
     pos_y = pos_y - center[1]
     
     # Correct for bad tracking
-    pos_data_corrected = remBadTrack(pos_x, pos_y, pos_t, 2)
+    complete_t = np.asarray(pos_t, dtype=float).flatten()
+    keep = badTrackMask(pos_x, pos_y, 2)
+    pos_data_corrected = remBadTrack(pos_x, pos_y, pos_t, 2, keep=keep)
     pos_x = pos_data_corrected[0]
     pos_y = pos_data_corrected[1]
     pos_t = pos_data_corrected[2]  
@@ -267,6 +513,10 @@ def grab_position_data(pos_path: str, ppm: int) -> tuple:
     pos_t = pos_t[nonNanValues]
     pos_x = pos_x[nonNanValues]
     pos_y = pos_y[nonNanValues]
+    keep[np.flatnonzero(keep)[np.isnan(pos_data_corrected[0].flatten())]] = False
+    
+    # Head direction from the two LEDs, unsmoothed
+    pos_hd = getheaddir(pos_path)[:len(keep)][keep]
     
     # Smooth data using boxcar convolution
     B = np.ones((int(np.ceil(0.4 * Fs_pos)), 1)) / np.ceil(0.4 * Fs_pos)
@@ -276,4 +526,4 @@ def grab_position_data(pos_path: str, ppm: int) -> tuple:
     pos_x_width = max(pos_x) - min(pos_x)
     pos_y_width = max(pos_y) - min(pos_y)
     
-    return pos_x, pos_y, pos_t, (pos_x_width, pos_y_width)
\ No newline at end of file
+    return pos_x, pos_y, pos_t, (pos_x_width, pos_y_width), (complete_t, keep), pos_hd
\ No newline at end of file
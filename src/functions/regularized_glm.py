@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Ridge regularized GLMs fitted along a path of penalty strengths, each fit
+warm started from the previous one, with the penalty chosen by cross-validated
+deviance on contiguous time-block folds.
+"""
+
+import numpy as np
+import statsmodels.api as sm
+from dataclasses import dataclass
+from .neuron_functions import GLM_FAMILIES
+from .cross_validation import block_folds, split_fold
+
+# Families with a regularization path
+REGULARIZED_FAMILIES = ['Poisson', 'Gamma', 'Gaussian']
+
+# =========================================================================== #
+
+def _model_data(X: np.ndarray, y: np.ndarray, exposure: np.ndarray, family) -> tuple:
+
+    '''
+        Same conventions as choose_GLM_model: the exposure is a log offset of
+        log link families, other families are fit on the rate.
+    '''
+
+    X = np.asarray(X, dtype=float).reshape((len(X), -1))
+    y = np.asarray(y, dtype=float)
+    offset = np.zeros(len(y))
+    if exposure is not None:
+        if isinstance(family.link, sm.families.links.Log):
+            offset = np.log(exposure)
+        else:
+            y = y / exposure
+    return X, y, offset
+
+# =========================================================================== #
+
+def ridge_irls(X: np.ndarray, y: np.ndarray, family, alpha: float, offset: np.ndarray,
+               penalized: np.ndarray, start: np.ndarray = None, max_iter: int = 100,
+               tol: float = 1e-8) -> tuple:
+
+    '''
+        Minimizes deviance / (2 n) + alpha / 2 * ||params[penalized]||^2 by
+        iteratively reweighted ridge regression, halving steps that do not
+        decrease the objective. After every step the next Newton step
+        A^-1 g, from the gradient g at the new params and the weighted
+        normal matrix A of the step just taken, estimates how far the params
+        are from the minimum. Iterations stop once it is below tol relative
+        to the params. The check needs no new normal matrix, so a warm start
+        near the solution (and any Gaussian fit) takes a single iteration.
+
+        Params:
+            X, y, offset (np.ndarray):
+                Design, response and linear predictor offset
+            family (statsmodels family):
+                Provides the link, variance and deviance
+            alpha (float):
+                Penalty strength
+            penalized (np.ndarray):
+                Boolean mask of the penalized columns
+            start (np.ndarray):
+                Warm start, the statsmodels starting mu if None or if the
+                warm start gives an invalid mean
+            tol (float):
+                Relative tolerance on the estimated Newton step, about the
+                relative accuracy of the params
+
+        Returns:
+            Tuple: params, converged, n_iter (weighted normal matrices formed)
+    '''
+
+    n, p = X.shape
+    penalty = alpha * np.diag(penalized.astype(float))
+
+    def objective(params):
+        # A step or start far off can overflow the mean, it is then rejected
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            mu = family.link.inverse(X @ params + offset)
+            value = family.deviance(y, mu) / (2 * n) + alpha / 2 * np.sum(params[penalized] ** 2)
+        return value if np.isfinite(value) else np.inf
+
+    previous = np.inf if start is None else objective(start)
+    if np.isfinite(previous):
+        params = start
+        eta = X @ params + offset
+        mu = family.link.inverse(eta)
+    else:
+        mu = family.starting_mu(y)
+        eta = family.link(mu)
+        params = np.zeros(p)
+
+    for n_iter in range(1, max_iter + 1):
+        derivative = family.link.deriv(mu)
+        weights = 1 / (family.variance(mu) * derivative ** 2)
+        z = eta - offset + (y - mu) * derivative
+
+        A = (X.T * weights) @ X / n + penalty
+        b = (X.T * weights) @ z / n
+        update = np.linalg.solve(A, b)
+
+        # Step halving towards the previous params if the objective increased
+        current = objective(update)
+        for _ in range(20):
+            if current <= previous and np.isfinite(current):
+                break
+            update = (update + params) / 2
+            current = objective(update)
+
+        params = update
+        eta = X @ params + offset
+        mu = family.link.inverse(eta)
+        previous = current
+
+        # Gradient of the objective at the new params
+        gradient = penalty @ params - X.T @ ((y - mu) / (family.variance(mu) * family.link.deriv(mu))) / n
+        if np.abs(np.linalg.solve(A, gradient)).max() <= tol * (np.abs(params).max() + tol):
+            return params, True, n_iter
+
+    return params, False, max_iter
+
+# =========================================================================== #
+
+def ridge_path(X: np.ndarray, y: np.ndarray, family, alphas: np.ndarray, offset: np.ndarray,
+               penalized: np.ndarray, tol: float = 1e-5) -> tuple:
+
+    '''
+        Fits every penalty of alphas (strongest first). Each fit is warm
+        started from the previous solutions, extrapolated linearly in
+        log(alpha), so most penalties take a single IRLS iteration. tol is
+        the relative accuracy of the params (see ridge_irls), which only
+        needs to be well below the noise of the held-out deviance.
+
+        Returns:
+            Tuple: params (n_alphas x n_params), converged, total IRLS iterations
+    '''
+
+    params = np.zeros((len(alphas), X.shape[1]))
+    converged = np.zeros(len(alphas), dtype=bool)
+    n_iter = 0
+    for i, alpha in enumerate(alphas):
+        start = None
+        if i == 1:
+            start = params[0]
+        elif i > 1:
+            ratio = np.log(alpha / alphas[i - 1]) / np.log(alphas[i - 1] / alphas[i - 2])
+            start = params[i - 1] + (params[i - 1] - params[i - 2]) * ratio
+        params[i], converged[i], iterations = ridge_irls(X, y, family, alpha, offset, penalized, start, tol=tol)
+        n_iter += iterations
+
+    return params, converged, n_iter
+
+# =========================================================================== #
+
+class RidgeResults:
+
+    '''
+        Ridge fit at the chosen penalty, with the attributes of statsmodels
+        GLM results used by GLMPipeline.
+
+        The AIC and BIC count every coefficient as a parameter.
+    '''
+
+    def __init__(self, path, X, y, offset):
+
+        self.path = path
+        self.params = path.params[path.best]
+        self.family = path.family
+        self.converged = bool(path.converged[path.best])
+
+        mu = self.family.link.inverse(X @ self.params + offset)
+        n, p = X.shape
+        self.deviance = self.family.deviance(y, mu)
+        self.scale = 1. if isinstance(self.family, (sm.families.Poisson, sm.families.Binomial)) else \
+            np.sum((y - mu) ** 2 / self.family.variance(mu)) / (n - p)
+        self.llf = self.family.loglike(y, mu, scale=self.scale)
+        self.aic = -2 * self.llf + 2 * p
+        self.bic_llf = -2 * self.llf + p * np.log(n)
+
+    # ------------------------------------------- #
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        X = np.asarray(X, dtype=float).reshape((len(X), -1))
+        return self.family.link.inverse(X @ self.params)
+
+# =========================================================================== #
+
+@dataclass
+class RegularizationPath:
+
+    '''
+        Ridge regularization path of a family, see regularization_path.
+    '''
+
+    family: object              # statsmodels family
+    alphas: np.ndarray          # Penalties, strongest first
+    params: np.ndarray          # n_alphas x n_params coefficients fit on all the data
+    converged: np.ndarray       # Convergence of every fit of the path
+    cv_deviance: np.ndarray     # Held-out deviance of every penalty, summed over folds
+    best: int                   # Index of the penalty with the lowest held-out deviance
+    n_iter: int                 # IRLS iterations over the folds, the final path and the refit
+
+    @property
+    def best_alpha(self) -> float:
+        return self.alphas[self.best]
+
+# =========================================================================== #
+
+def regularization_path(X: np.ndarray, y: np.ndarray, family: str, exposure: np.ndarray = None,
+                        alphas: np.ndarray = None, k: int = 5, gap: int = 0, **family_params) -> RidgeResults:
+
+    '''
+        Fits a ridge regularization path and chooses the penalty by held-out
+        deviance on k contiguous time-block folds. Columns are scaled to unit
+        variance before fitting. The first constant non-zero column is the
+        intercept, neither scaled nor penalized. Other constant columns (an
+        all-zero spline basis function, a second intercept) are penalized,
+        so their coefficients stay at zero instead of making the normal
+        matrix singular. With an intercept the other columns are also
+        centered, which only moves their means into the intercept, so the
+        penalty does not depend on the means of the covariates. Without one,
+        centering would add an intercept to the model, and the penalty
+        shrinks towards zero rate at the origin of the covariates.
+
+        Params:
+            X, y, exposure (np.ndarray):
+                Model data without missing values, see prepare_GLM_data
+            family (str):
+                One of REGULARIZED_FAMILIES
+            alphas (np.ndarray):
+                Penalties, np.logspace(1, -6, 50) if None. Sorted strongest
+                first so each fit warm starts from a more penalized one
+            k, gap (int):
+                Folds, see cross_validation.block_folds
+            **family_params:
+                Passed to the family
+
+        Returns:
+            RidgeResults:
+                Fit at the chosen penalty, the path is in its path attribute
+    '''
+
+    if family not in REGULARIZED_FAMILIES:
+        raise ValueError("No regularization path for the %s family, available: %s"
+                         % (family, ', '.join(REGULARIZED_FAMILIES)))
+    model_family = GLM_FAMILIES[family](**family_params)
+    X, y, offset = _model_data(X, y, exposure, model_family)
+
+    if alphas is None:
+        alphas = np.logspace(1, -6, 50)
+    alphas = np.sort(np.asarray(alphas, dtype=float))[::-1]
+
+    # Unit variance columns so the penalty weighs every covariate alike
+    scale = X.std(axis=0)
+    constant = scale == 0
+    scale[constant] = 1
+    intercept = np.flatnonzero(constant & (X[0] != 0))[:1] if len(X) > 0 else []
+    penalized = np.ones(X.shape[1], dtype=bool)
+    penalized[intercept] = False
+    center = np.zeros(X.shape[1])
+    if len(intercept) > 0:
+        center[~constant] = X[:, ~constant].mean(axis=0)
+    X_scaled = (X - center) / scale
+
+    cv_deviance = np.zeros(len(alphas))
+    n_iter = 0
+    for fold in block_folds(len(y), k, gap):
+        X_train, X_test = split_fold(X_scaled, fold)
+        y_train, y_test = split_fold(y, fold)
+        offset_train, offset_test = split_fold(offset, fold)
+
+        params, _, iterations = ridge_path(X_train, y_train, model_family, alphas, offset_train, penalized)
+        n_iter += iterations
+        mu = model_family.link.inverse(X_test @ params.T + offset_test[:, None])
+        cv_deviance += [model_family.deviance(y_test, mu[:, i]) for i in range(len(alphas))]
+
+    params, converged, iterations = ridge_path(X_scaled, y, model_family, alphas, offset, penalized)
+    n_iter += iterations
+
+    # The chosen penalty is refined to the default accuracy of ridge_irls
+    cv_deviance[~np.isfinite(cv_deviance)] = np.inf
+    best = int(np.argmin(cv_deviance))
+    params[best], converged[best], iterations = ridge_irls(X_scaled, y, model_family, alphas[best], offset,
+                                                           penalized, params[best])
+    n_iter += iterations
+
+    # Back to the coefficients of the original columns
+    params = params / scale
+    if len(intercept) > 0:
+        params[:, intercept[0]] -= params @ center / X[0, intercept[0]]
+
+    path = RegularizationPath(model_family, alphas, params, converged, cv_deviance, best, n_iter)
+
+    return RidgeResults(path, X, y, offset)
+
+# =========================================================================== #
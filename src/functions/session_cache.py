@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of parsed and preprocessed Axona sessions. Each 
+session is stored as a folder of .npy files which are memory-mapped when the 
+session is opened again, instead of re-parsing the .pos, .cut and tetrode files.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from .neuron_functions import load_neurons, grab_position_data, UnitSpikeIndex
+
+# Bump when the content or layout of the cached arrays changes
+CACHE_VERSION = 3
+
+# =========================================================================== #
+
+def default_cache_dir() -> str: 
+    
+    '''
+        Cache folder, set by the BURSTFIT_CACHE_DIR environment variable or 
+        ~/.burstfit_cache by default.
+    '''
+    
+    return os.environ.get('BURSTFIT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.burstfit_cache'))
+
+# =========================================================================== #
+
+def _source_stamp(files: list, ppm: int) -> dict: 
+    
+    '''
+        Describes the sources of a cache entry. The entry is stale as soon 
+        as any of these values changes.
+    '''
+    
+    sources = []
+    for file in files:
+        stat = os.stat(file)
+        sources.append([os.path.abspath(file), stat.st_size, stat.st_mtime_ns])
+        
+    return {'version': CACHE_VERSION, 'ppm': ppm, 'sources': sources}
+
+# =========================================================================== #
+
+def load_session(pos_file: str, cut_file: str, tetrode_file: str, ppm: int, cache_dir: str = None) -> tuple: 
+    
+    '''
+        Loads the spike and position data of a session, from the cache when 
+        an up to date entry exists. Otherwise the source files are parsed 
+        and the result is written to the cache. 
+        
+        Entries are keyed by source paths and ppm. An entry whose recorded 
+        file sizes or modification times no longer match the source files 
+        is deleted and rebuilt. 
+
+        Params: 
+            pos_file, cut_file, tetrode_file (str): 
+                Paths of the position, cut and tetrode files 
+            ppm (int): 
+                Pixel per meter value 
+            cache_dir (str): 
+                Cache folder, default_cache_dir() if None
+
+        Returns: 
+            Tuple: raw_spike_data, empty_cell, position_data
+            --------
+            raw_spike_data (UnitSpikeIndex): 
+                Spike times of every unit (memory-mapped from the cache)
+            empty_cell (int): 
+                The 'gap' cell, see load_neurons
+            position_data (tuple): 
+                pos_x, pos_y, pos_t, arena_size, (complete_t, keep), pos_hd 
+                as returned by grab_position_data
+    '''
+    
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+        
+    files = [pos_file, cut_file, tetrode_file]
+    stamp = _source_stamp(files, ppm)
+    key = hashlib.sha1(json.dumps([[source[0] for source in stamp['sources']], ppm]).encode()).hexdigest()
+    entry = os.path.join(cache_dir, key)
+    
+    # Up to date entry, memory-map it
+    try:
+        with open(os.path.join(entry, 'manifest.json'), 'r') as f:
+            if json.load(f) == stamp:
+                return _read_entry(entry, tetrode_file)
+    except (OSError, ValueError):
+        pass
+    
+    # Missing or stale entry, parse the session
+    raw_spike_data, empty_cell = load_neurons(cut_file, tetrode_file, channel_no=1)
+    position_data = grab_position_data(pos_file, ppm)
+    
+    try:
+        _write_entry(entry, stamp, raw_spike_data, position_data)
+    except OSError:
+        # A cache that cannot be written should not prevent loading the session
+        pass
+    
+    return raw_spike_data, empty_cell, position_data
+
+# =========================================================================== #
+
+def _write_entry(entry: str, stamp: dict, raw_spike_data: UnitSpikeIndex, position_data: tuple) -> None: 
+    
+    '''
+        Writes a cache entry into a temporary folder which then replaces the 
+        entry, so a partially written entry is never read.
+    '''
+    
+    cache_dir = os.path.dirname(entry)
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=cache_dir, prefix=os.path.basename(entry) + '.tmp')
+    
+    try:
+        # Cut label of every spike, in tetrode file order
+        cut_labels = np.empty(len(raw_spike_data.order), dtype=np.int32)
+        cut_labels[raw_spike_data.order] = np.repeat(np.arange(len(raw_spike_data)), raw_spike_data.counts)
+        
+        arrays = {
+            'spike_order': raw_spike_data.order,
+            'spike_offsets': raw_spike_data.offsets,
+            'spike_times': raw_spike_data.times,
+            'cut_labels': cut_labels,
+            'pos_x': position_data[0],
+            'pos_y': position_data[1],
+            'pos_t': position_data[2],
+            'arena_size': np.asarray(position_data[3], dtype=float),
+            'pos_complete_t': position_data[4][0],
+            'pos_keep': position_data[4][1],
+            'pos_hd': position_data[5],
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary, name + '.npy'), array)
+        
+        # The manifest goes last, an entry is only valid once it exists
+        with open(os.path.join(temporary, 'manifest.json'), 'w') as f:
+            json.dump(stamp, f)
+        
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(temporary, entry)
+        
+    finally:
+        shutil.rmtree(temporary, ignore_errors=True)
+
+# =========================================================================== #
+
+def _read_entry(entry: str, tetrode_file: str) -> tuple: 
+    
+    '''
+        Memory-maps the arrays of a cache entry. 
+    '''
+    
+    def load(name):
+        return np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+    
+    raw_spike_data = UnitSpikeIndex(load('spike_order'), load('spike_offsets'), load('spike_times'), 
+                                    tetrode_file, channel_no=1)
+    position_data = (load('pos_x'), load('pos_y'), load('pos_t'), tuple(np.array(load('arena_size'))), 
+                     (load('pos_complete_t'), load('pos_keep')), load('pos_hd'))
+    
+    return raw_spike_data, raw_spike_data.empty_cell, position_data
+
+# =========================================================================== #
@@ -11,13 +11,15 @@ import numpy as np
 import matplotlib
 import shutil
 
-from compute_GLM import compute_GLM
-from worker_thread.Worker import Worker
+from compute_GLM import compute_GLM, compare_GLM_families
+from functions.fit_cache import FitCache
+from functions.decimation import DecimationPyramid, pixel_thin
+from worker_thread.JobScheduler import JobScheduler
 from openpyxl.utils.cell import get_column_letter
 from PIL import Image, ImageQt
 from functools import partial
 from matplotlib import cm
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 from matplotlib.figure import Figure
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtCore import QThread, Qt, QThreadPool
@@ -93,6 +95,8 @@ class mainWindow(QWidget):
         self.x = None
         self.y = None
         self.prediction = None              # Holds GLM prediction
+        self.params = None                  # Holds fitted GLM coefficients
+        self.deviance = None                # Holds fitted GLM deviance
         self.ppm = None
         self.files = [None, None, None]           # Holds a reference to pos, cut and tetrode file
         self.active_folder = ''             # Holds last directory path opened by user for choosing files
@@ -102,21 +106,30 @@ class mainWindow(QWidget):
         self.family = 'Poisson'
         self.error = None
         self.graphType = 'Rate'
+        self.binning = 'Adaptive'
+        self.fit_cache = FitCache()         # Holds previously fitted results
+        self.scheduler = JobScheduler()     # Runs the GLM computations, only the newest is shown
+        self.compare_scheduler = JobScheduler(max_threads=1)    # Runs family comparisons
+        self.traces = []                    # Plotted lines and their decimation pyramids
+        self.scatter = None                 # Plotted scatter and its (x, y) data
          
         # Widget creation
         session_Label = QLabel("Session:")
         model_Label = QLabel("Model type:")
         graph_Label = QLabel("Graph type:")
+        binning_Label = QLabel("Binning:")
         ppm_Label = QLabel("Pixel Per Meter value:")
         ppmTextBox = QLineEdit(self)
         self.session_Text = QLabel()
         self.neuron_Label = QLabel("Available Neurons")
         self.modelBox = QComboBox()
         self.graphBox = QComboBox()
+        self.binningBox = QComboBox()
         
         quit_button = QPushButton('Quit', self)
         browse_button = QPushButton('Browse files', self)
         save_button = QPushButton('Save images', self)
+        compare_button = QPushButton('Compare families', self)
         self.bar = QProgressBar(self)
         self.listWidget = QListWidget()
         
@@ -129,13 +142,18 @@ class mainWindow(QWidget):
         self.graphBox.addItem("Rate")
         self.graphBox.addItem("Rate_vs_Speed")
         
+        self.binningBox.addItem("Adaptive")
+        self.binningBox.addItem("Fixed_grid")
+        
         # Create canvas widgets used later for plotting image data
         self.rate_plot = MplCanvas()
+        plot_toolbar = NavigationToolbar2QT(self.rate_plot, self)
         
         # Instantiating widget properties 
         self.bar.setOrientation(Qt.Vertical)
         self.modelBox.setFixedWidth(125)
         self.graphBox.setFixedWidth(125)
+        self.binningBox.setFixedWidth(125)
         self.listWidget.setFixedWidth(100)
         browse_button.setFixedWidth(300)
         ppmTextBox.setFixedWidth(125)
@@ -148,20 +166,35 @@ class mainWindow(QWidget):
         self.layout.addWidget(save_button, 1,2)
         self.layout.addWidget(model_Label, 2, 0)
         self.layout.addWidget(self.modelBox, 2, 1)
+        self.layout.addWidget(compare_button, 2, 2)
         self.layout.addWidget(ppm_Label, 3, 0)
         self.layout.addWidget(ppmTextBox, 3, 1)
-        self.layout.addWidget(self.neuron_Label, 4, 0)
-        self.layout.addWidget(self.listWidget, 5, 0)
-        self.layout.addWidget(self.rate_plot, 5, 1)
-        self.layout.addWidget(self.bar, 5, 2)
+        self.layout.addWidget(binning_Label, 4, 0)
+        self.layout.addWidget(self.binningBox, 4, 1)
+        self.layout.addWidget(self.neuron_Label, 5, 0)
+        self.layout.addWidget(plot_toolbar, 5, 1)
+        self.layout.addWidget(self.listWidget, 6, 0)
+        self.layout.addWidget(self.rate_plot, 6, 1)
+        self.layout.addWidget(self.bar, 6, 2)
         
         # Widget signaling
         quit_button.clicked.connect(self.quitClicked)
         browse_button.clicked.connect(self.runSession)
+        compare_button.clicked.connect(self.compareFamilies)
         self.listWidget.currentItemChanged.connect(self.cellChanged)
         self.graphBox.activated[str].connect(self.graphChanged)
         self.modelBox.activated[str].connect(self.modelChanged)
+        self.binningBox.activated[str].connect(self.binningChanged)
         ppmTextBox.textChanged[str].connect(partial(self.textBoxChanged, 'ppm'))
+        self.scheduler.result.connect(self.setData)
+        self.scheduler.result.connect(self.prefetchNeighbours)
+        self.scheduler.completed.connect(self.cacheResult)
+        self.scheduler.progress.connect(self.progressBar)
+        self.scheduler.error.connect(self.errorOccured)
+        self.compare_scheduler.result.connect(self.showComparison)
+        self.compare_scheduler.completed.connect(self.cacheComparison)
+        self.compare_scheduler.progress.connect(self.progressBar)
+        self.compare_scheduler.error.connect(self.errorOccured)
                 
     # ------------------------------------------- #  
     
@@ -201,6 +234,18 @@ class mainWindow(QWidget):
         
     # ------------------------------------------- #  
     
+    def binningChanged(self, value): 
+
+        '''
+            Updates binning mode between adaptive rate bins and fixed grid spike counts
+        '''
+        
+        self.binning = value
+        if self.cell_data is not None:
+            self.runWorkerThread()
+        
+    # ------------------------------------------- #  
+    
     def textBoxChanged(self, label):
         
         '''
@@ -246,7 +291,7 @@ class mainWindow(QWidget):
             extension = file.split(sep='.')[1]
             if 'pos' in extension:
                 self.files[0] = file
-            elif 'cut' in extension:
+            elif 'cut' in extension or 'clu' in extension:
                 self.files[1] = file
             elif extension.isnumeric():
                 self.files[2] = file
@@ -351,6 +396,8 @@ class mainWindow(QWidget):
         self.x = data[1]
         self.y = data[2]
         self.prediction = data[3]
+        self.params = data[4]
+        self.deviance = data[5]
         
         # Re-render list widget of available neurons
         if self.re_render:
@@ -359,37 +406,186 @@ class mainWindow(QWidget):
                 self.listWidget.addItem(QListWidgetItem(str(i+1)))
             self.re_render = False
             
+        # Only the decimated view of the traces is drawn, see refineView
+        axes = self.rate_plot.axes
+        axes.cla()
+        x = np.asarray(self.x, dtype=float).flatten()
+        y = np.asarray(self.y, dtype=float).flatten()
+        prediction = np.asarray(self.prediction, dtype=float).flatten()
+        
         if self.graphType == 'Rate':
-            self.rate_plot.axes.cla()
-            self.rate_plot.axes.set_xlabel('Time')
-            self.rate_plot.axes.set_ylabel('Rate (Hz)')
-            self.rate_plot.axes.plot(self.x, self.y, linewidth=0.5)
-            self.rate_plot.axes.plot(self.x, self.prediction, linewidth=1)
-            self.rate_plot.draw()
+            axes.set_xlabel('Time')
+            axes.set_ylabel('Rate (Hz)')
+            self.traces = [(axes.plot([], [], linewidth=0.5)[0], DecimationPyramid(x, y)), 
+                           (axes.plot([], [], linewidth=1)[0], DecimationPyramid(x, prediction))]
+            self.scatter = None
         else:
-            self.rate_plot.axes.cla()
-            self.rate_plot.axes.set_xlabel('Speed')
-            self.rate_plot.axes.set_ylabel('Rate (Hz)')
-            self.rate_plot.axes.scatter(self.x, self.y, s=1)
-            self.rate_plot.axes.plot(self.x, self.prediction, color='green', linewidth=1, )
-            self.rate_plot.draw()
+            axes.set_xlabel('Speed')
+            axes.set_ylabel('Rate (Hz)')
+            # Speed samples are unordered, the prediction is drawn along sorted speed
+            order = np.argsort(x, kind='stable')
+            self.scatter = (axes.scatter([], [], s=1), (x, y))
+            self.traces = [(axes.plot([], [], color='green', linewidth=1)[0], 
+                            DecimationPyramid(x[order], prediction[order]))]
+        
+        # Full view limits: the coarse traces keep the extremes of the data
+        for line, pyramid in self.traces: 
+            line.set_data(*pyramid.view(n_points=2 * int(axes.bbox.width)))
+        axes.relim()
+        if self.scatter is not None:
+            finite = np.isfinite(x) & np.isfinite(y)
+            if finite.any():
+                axes.update_datalim([[x[finite].min(), y[finite].min()], [x[finite].max(), y[finite].max()]])
+        axes.autoscale_view()
+        
+        self.refineView(axes)
+        # cla() drops the callbacks, reconnect them to the new axes
+        axes.callbacks.connect('xlim_changed', self.refineView)
+        if self.scatter is not None:
+            axes.callbacks.connect('ylim_changed', self.refineView)
+        self.rate_plot.draw()
             
     # ------------------------------------------- # 
+    
+    def refineView(self, axes):
+        
+        '''
+            Redraws the plotted traces at the level of detail of the current 
+            view: about two points per pixel column for lines, one point per 
+            occupied pixel for the scatter. Called on zoom and pan.
+        '''
+        
+        x_min, x_max = axes.get_xlim()
+        width, height = max(int(axes.bbox.width), 1), max(int(axes.bbox.height), 1)
+        
+        for line, pyramid in self.traces: 
+            line.set_data(*pyramid.view(x_min, x_max, 2 * width))
+            
+        if self.scatter is not None:
+            collection, (x, y) = self.scatter
+            visible = pixel_thin(x, y, (x_min, x_max), axes.get_ylim(), width, height)
+            collection.set_offsets(np.column_stack([x[visible], y[visible]]))
+            
+    # ------------------------------------------- # 
+        
+    def cacheResult(self, key, data):
+        
+        '''
+            Stores a result returned by a scheduled job in the fit cache
+        '''
+        
+        self.fit_cache.put(key, data[1:])
+        
+    # ------------------------------------------- # 
         
     def runWorkerThread(self):
 
         '''
-            Launches worker thread to compute GLM prediction
+            Schedules the GLM computation on the thread pool, unless the 
+            result is already in the fit cache. Any computation still running 
+            for a previous selection is cancelled.
+        '''
+        
+        if None in self.files:
+            self.errorOccured('You must choose one .pos one .cut, and one tetrode file')
+            return
+        
+        key = FitCache.make_key(self.files, self.ppm, self.cell, self.family, self.graphType, 
+                                binning=self.binning)
+        
+        # Previously viewed combination, no need to run a job
+        if self.cell_data is not None:
+            result = self.fit_cache.get(key)
+            if result is not None:
+                self.scheduler.cancel_all()
+                self.setData((self.cell_data,) + result)
+                self.prefetchNeighbours()
+                return
+
+        # Passes compute_GLM to the scheduler, results are connected in mainUI
+        self.scheduler.submit(key, compute_GLM, self.files, self.cell, self.ppm, self.family, self.graphType, 
+                              cell_data=self.cell_data, binning=self.binning)
+        
+    # ------------------------------------------- # 
+        
+    def prefetchNeighbours(self, *args):
+
+        '''
+            Computes in the background the fits most likely to be viewed next,
+            the neighbouring cells and the other families of the current cell.
+            Any new selection pre-empts them.
         '''
+        
+        if self.cell_data is None:
+            return
+        
+        families = [self.modelBox.itemText(i) for i in range(self.modelBox.count())]
+        requests = [(cell, self.family) for cell in [self.cell + 1, self.cell - 1] if 1 <= cell <= self.empty_cell]
+        requests += [(self.cell, family) for family in families if family != self.family]
+        
+        for cell, family in requests:
+            key = FitCache.make_key(self.files, self.ppm, cell, family, self.graphType, binning=self.binning)
+            if key not in self.fit_cache:
+                self.scheduler.prefetch(key, compute_GLM, self.files, cell, self.ppm, family, self.graphType, 
+                                        cell_data=self.cell_data, binning=self.binning)
+
+    # ------------------------------------------- # 
+        
+    def compareFamilies(self):
 
-        # Passes compute_all_map_data function to worker thread
-        self.worker = Worker(compute_GLM, self.files, self.cell, self.ppm, self.family, self.graphType, cell_data=self.cell_data)
-        # Connects PyQt5 signals to listeners
-        self.worker.signals.return_data.connect(self.setData)
-        self.worker.signals.progress.connect(self.progressBar)
-        self.worker.signals.error.connect(self.errorOccured)
-        # Starts the thread
-        self.worker.start()
+        '''
+            Fits every family for the current cell and graph in the background,
+            the ranked table is shown by showComparison.
+        '''
+        
+        if self.cell_data is None:
+            return
+        
+        tag = (list(self.files), self.ppm, self.binning)
+        self.compare_scheduler.submit(tag, compare_GLM_families, self.files, self.cell, self.ppm, self.graphType, 
+                                      cell_data=self.cell_data, binning=self.binning)
+        
+    # ------------------------------------------- # 
+        
+    def cacheComparison(self, tag, rows):
+        
+        '''
+            Stores every fit of a family comparison in the fit cache
+        '''
+        
+        files, ppm, binning = tag
+        for row in rows:
+            if row.result is not None:
+                result = row.result
+                key = FitCache.make_key(files, ppm, result.cell, row.family, result.graph, binning=binning)
+                self.fit_cache.put(key, (result.x, result.y, result.prediction, result.params, result.deviance))
+        
+    # ------------------------------------------- # 
+        
+    def showComparison(self, rows):
+        
+        '''
+            Shows the ranked family comparison in a table dialog. Ranks are 
+            only comparable within a group.
+        '''
+        
+        columns = ['Family', 'Group', 'Rank', 'AIC', 'BIC', 'Deviance', 'Converged', 'Fit time (s)', 'Note']
+        table = QTableWidget(len(rows), len(columns))
+        table.setHorizontalHeaderLabels(columns)
+        for i, row in enumerate(rows):
+            values = [row.family, row.group or '', '' if row.rank is None else str(row.rank), 
+                      '%.2f' % row.aic, '%.2f' % row.bic, '%.2f' % row.deviance, 
+                      str(row.converged), '%.3f' % row.fit_time, row.error or row.not_ranked or '']
+            for j, value in enumerate(values):
+                table.setItem(i, j, QTableWidgetItem(value))
+        table.resizeColumnsToContents()
+        
+        self.comparison_dialog = QDialog(self)
+        self.comparison_dialog.setWindowTitle('Family comparison')
+        layout = QVBoxLayout(self.comparison_dialog)
+        layout.addWidget(table)
+        self.comparison_dialog.resize(700, 300)
+        self.comparison_dialog.show()
 
 # =========================================================================== #
 
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of fit_poisson_batch against statsmodels. Run from the src folder:
+    python -m pytest tests
+"""
+
+import numpy as np
+import statsmodels.api as sm
+from functions.batched_glm import fit_poisson_batch
+
+# =========================================================================== #
+
+def _design(n_samples: int = 2000, seed: int = 0) -> tuple:
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([np.ones(n_samples), rng.normal(size=n_samples)])
+    counts = rng.poisson(np.exp(0.2 + 0.4 * X[:, 1])).astype(float)
+    return X, counts
+
+# =========================================================================== #
+
+def test_matches_statsmodels():
+
+    X, counts = _design()
+    fit = fit_poisson_batch(X, counts[:, None])
+    reference = sm.GLM(counts, X, family=sm.families.Poisson()).fit()
+
+    np.testing.assert_allclose(fit.params[:, 0], reference.params, rtol=1e-8)
+    np.testing.assert_allclose(fit.deviance[0], reference.deviance, rtol=1e-8)
+    assert fit.converged[0]
+
+# =========================================================================== #
+
+def test_unit_without_spikes():
+
+    # A silent unit, and one whose responses are all missing, next to a
+    # normal unit: only they fail, the normal unit is still fitted
+    X, counts = _design()
+    Y = np.column_stack([counts, np.zeros(len(counts)), np.full(len(counts), np.nan)])
+    fit = fit_poisson_batch(X, Y)
+    reference = fit_poisson_batch(X, counts[:, None])
+
+    np.testing.assert_allclose(fit.params[:, 0], reference.params[:, 0])
+    assert fit.converged.tolist() == [True, False, False]
+    assert np.isnan(fit.params[:, 1:]).all()
+    assert np.isnan(fit.deviance[1:]).all()
+
+# =========================================================================== #
+
+def test_only_units_without_spikes():
+
+    X, counts = _design()
+    fit = fit_poisson_batch(X, np.zeros((len(counts), 2)))
+
+    assert not fit.converged.any()
+    assert np.isnan(fit.params).all()
+    assert fit.n_iter == 0
+
+# =========================================================================== #
+
+def test_warm_start_matches_statsmodels():
+
+    # A subsample of 500 rows starts the fit, with an exposure and a
+    # missing response
+    X, counts = _design(8000)
+    exposure = np.random.default_rng(1).uniform(0.01, 0.03, len(counts))
+    counts = np.random.default_rng(2).poisson(np.exp(3 + 0.4 * X[:, 1]) * exposure).astype(float)
+    Y = np.column_stack([counts, counts[::-1]])
+    Y[10, 1] = np.nan
+    fit = fit_poisson_batch(X, Y, exposure, warm_start_rows=500)
+
+    for unit in range(2):
+        keep = ~np.isnan(Y[:, unit])
+        reference = sm.GLM(Y[keep, unit], X[keep], family=sm.families.Poisson(), exposure=exposure[keep]).fit()
+        np.testing.assert_allclose(fit.params[:, unit], reference.params, rtol=1e-8)
+    assert fit.converged.all()
+    assert fit.n_iter < reference.fit_history['iteration']
+
+# =========================================================================== #
+
+def test_unit_scores_match_statsmodels():
+
+    X, counts = _design()
+    exposure = np.full(len(counts), 0.02)
+    fit = fit_poisson_batch(X, counts[:, None], exposure).unit(0, X, counts, exposure)
+    reference = sm.GLM(counts, X, family=sm.families.Poisson(), exposure=exposure).fit()
+
+    for score in ['deviance', 'llf', 'aic', 'bic_llf']:
+        np.testing.assert_allclose(getattr(fit, score), getattr(reference, score), rtol=1e-8)
+    np.testing.assert_allclose(fit.predict(X), reference.predict(X), rtol=1e-8)
+
+# =========================================================================== #
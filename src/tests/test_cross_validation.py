@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the time-block cross-validation. Run from the src folder:
+    python -m pytest tests
+"""
+
+import numpy as np
+from functions.cross_validation import block_folds, split_fold, cross_validate
+
+# =========================================================================== #
+
+def _data(n_samples: int = 3000, seed: int = 0) -> tuple:
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([np.ones(n_samples), np.sin(np.linspace(0, 20, n_samples))])
+    exposure = np.full(n_samples, 0.02)
+    counts = rng.poisson(np.exp(3 + 0.5 * X[:, 1]) * exposure).astype(float)
+    return X, counts, exposure
+
+# =========================================================================== #
+
+def test_block_folds_cover_samples():
+
+    folds = block_folds(103, 5, gap=4)
+    tests = np.concatenate([np.arange(start, stop) for start, stop, _ in folds])
+
+    np.testing.assert_array_equal(tests, np.arange(103))
+    assert all(gap == 4 for _, _, gap in folds)
+
+# =========================================================================== #
+
+def test_split_fold_leaves_out_gap():
+
+    samples = np.arange(100)
+    for fold in block_folds(100, 4, gap=5):
+        start, stop, _ = fold
+        train, test = split_fold(samples, fold)
+
+        np.testing.assert_array_equal(test, np.arange(start, stop))
+        # Nothing within gap samples of the test block is trained on
+        distance = np.minimum(np.abs(train - start), np.abs(train - (stop - 1)))
+        assert distance.min() > 5
+        assert len(train) == 100 - (min(stop + 5, 100) - max(start - 5, 0))
+
+    assert split_fold(None, (0, 10, 5)) == (None, None)
+
+# =========================================================================== #
+
+def test_workers_agree():
+
+    X, counts, exposure = _data()
+    families = ['Poisson', 'Gaussian']
+    serial = cross_validate(X, counts, exposure, families, k=4, gap=10, workers=1)
+    parallel = cross_validate(X, counts, exposure, families, k=4, gap=10, workers=2)
+
+    for one, other in zip(serial, parallel):
+        assert one.family == other.family and one.error is None and other.error is None
+        np.testing.assert_allclose(one.loglike, other.loglike, rtol=1e-10)
+        np.testing.assert_allclose(one.pseudo_r2, other.pseudo_r2, rtol=1e-10)
+        np.testing.assert_allclose(one.fold_loglike, other.fold_loglike, rtol=1e-10)
+
+# =========================================================================== #
+
+def test_unsupported_response_is_not_scored():
+
+    # Gamma cannot model the zero rates of bins without a spike
+    X, counts, exposure = _data()
+    assert (counts == 0).any()
+    poisson, gamma = cross_validate(X, counts, exposure, ['Poisson', 'Gamma'], k=3)
+
+    assert poisson.error is None and np.isfinite(poisson.loglike)
+    assert np.isnan(gamma.loglike) and np.isnan(gamma.pseudo_r2)
+    assert gamma.error == 'Gamma needs positive responses'
+
+# =========================================================================== #
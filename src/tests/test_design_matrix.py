@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the covariate bases of design_matrix. Run from the src folder:
+    python -m pytest tests
+"""
+
+import numpy as np
+from functions.design_matrix import bspline_basis
+from functions.batched_glm import fit_poisson_batch
+
+# =========================================================================== #
+
+def _resting_speed(n_samples: int = 5000, seed: int = 0) -> np.ndarray:
+    # The animal rests 40% of the time, exact zero speed
+    rng = np.random.default_rng(seed)
+    speed = rng.gamma(2, 5, size=n_samples)
+    speed[rng.random(n_samples) < 0.4] = 0
+    return speed
+
+# =========================================================================== #
+
+def test_spline_full_rank_with_ties():
+
+    speed = _resting_speed()
+    basis = bspline_basis(speed, 8)
+
+    assert basis.shape == (len(speed), 7)
+    assert np.all(basis.any(axis=0))
+    X = np.column_stack([np.ones(len(speed)), basis])
+    assert np.linalg.matrix_rank(X) == X.shape[1]
+
+    # Fitting on the basis no longer hits a singular matrix
+    counts = np.random.default_rng(1).poisson(np.exp(0.5 + 0.02 * speed)).astype(float)
+    fit = fit_poisson_batch(X, counts[:, None])
+    assert fit.converged[0]
+
+# =========================================================================== #
+
+def test_spline_integer_positions():
+
+    # Integer pixel positions, most samples along two walls
+    rng = np.random.default_rng(2)
+    x = np.concatenate([np.zeros(3000), np.full(3000, 50), rng.integers(0, 51, size=2000)]).astype(float)
+    basis = bspline_basis(x, 6, drop_first=False)
+
+    assert np.all(basis.any(axis=0))
+    np.testing.assert_allclose(basis.sum(axis=1), 1)
+
+# =========================================================================== #
+
+def test_spline_quantile_knots_without_ties():
+
+    # Without ties the interior knots stay at the quantiles
+    x = np.random.default_rng(3).normal(size=1000)
+    basis = bspline_basis(x, 5, drop_first=False)
+    median = np.median(x)
+
+    # The middle basis function of a cubic spline with one interior knot peaks at it
+    assert abs(x[np.argmax(basis[:, 2])] - median) < 0.2
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the .cut and .clu.N label parsers on the small session in
+tests/data, against the labels the previous line by line parsers read from
+it. Run from the src folder:
+    python -m pytest tests
+"""
+
+import os
+import numpy as np
+import pytest
+from functions.Tint_Matlab import (TintException, parse_int_tokens, load_cut_labels, read_cut, read_clu,
+                                   find_label_file)
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+# Labels of the 30 spikes of tests/data/session.1
+LABELS = [0, 1, 1, 2, 0, 3, 3, 1, 2, 2, 0, 0, 1, 3, 2, 1, 1, 0, 2, 3, 3, 3, 1, 0, 2, 1, 0, 0, 2, 1]
+
+# =========================================================================== #
+
+def test_read_cut():
+
+    # The numbers of the header (cluster centres, spike count) are not labels
+    labels = read_cut(os.path.join(DATA, 'session_1.cut'))
+    assert labels.dtype == np.int32
+    np.testing.assert_array_equal(labels, LABELS)
+
+    assert read_cut(os.path.join(DATA, 'missing_1.cut')) is None
+
+# =========================================================================== #
+
+def test_read_clu():
+
+    # The previous parser (np.loadtxt) returned the same values as floats
+    labels = read_clu(os.path.join(DATA, 'session.clu.1'))
+    assert labels.dtype == np.int32
+    np.testing.assert_array_equal(labels, np.array(LABELS, dtype=float))
+
+    # Both label files of the session agree
+    np.testing.assert_array_equal(labels, load_cut_labels(os.path.join(DATA, 'session_1.cut')))
+
+# =========================================================================== #
+
+def test_labels_checked_against_tetrode(tmp_path):
+
+    tetrode_file = os.path.join(DATA, 'session.1')
+    assert find_label_file(tetrode_file) == os.path.join(DATA, 'session_1.cut')
+    for label_file in ['session_1.cut', 'session.clu.1']:
+        np.testing.assert_array_equal(load_cut_labels(os.path.join(DATA, label_file), tetrode_file), LABELS)
+
+    # A cut file of another session, one spike short
+    with open(os.path.join(DATA, 'session_1.cut'), 'rb') as f:
+        data = f.read()
+    short_cut = tmp_path / 'short_1.cut'
+    short_cut.write_bytes(data.rstrip()[:-2])
+    assert len(load_cut_labels(str(short_cut))) == len(LABELS) - 1
+    with pytest.raises(TintException):
+        load_cut_labels(str(short_cut), tetrode_file)
+
+    no_labels = tmp_path / 'empty_1.cut'
+    no_labels.write_bytes(data[:data.find(b'Exact_cut')])
+    with pytest.raises(TintException):
+        load_cut_labels(str(no_labels))
+
+# =========================================================================== #
+
+def test_parse_int_tokens():
+
+    np.testing.assert_array_equal(parse_int_tokens(b'0 12\r\n 7,003\t999999999\n'), [0, 12, 7, 3, 999999999])
+    assert parse_int_tokens(b'12').dtype == np.int32
+    assert len(parse_int_tokens(b'')) == 0
+    assert len(parse_int_tokens(b' \r\n')) == 0
+
+    with pytest.raises(TintException):
+        parse_int_tokens(b'1 1234567890')
+
+# =========================================================================== #
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the ridge regularization path. Run from the src folder:
+    python -m pytest tests
+"""
+
+import numpy as np
+import statsmodels.api as sm
+from functions.regularized_glm import ridge_irls, regularization_path
+
+# =========================================================================== #
+
+def _data(n_samples: int = 4000, seed: int = 0) -> tuple:
+    # Covariates far from zero, so centering moves a lot into the intercept
+    rng = np.random.default_rng(seed)
+    speed = rng.gamma(2, 5, size=n_samples) + 20
+    position = rng.uniform(100, 300, size=n_samples)
+    X = np.column_stack([np.ones(n_samples), speed, position])
+    exposure = np.full(n_samples, 0.02)
+    counts = rng.poisson(np.exp(1 + 0.03 * speed + 0.004 * position) * exposure).astype(float)
+    return X, counts, exposure
+
+# =========================================================================== #
+
+def test_tiny_penalty_matches_statsmodels():
+
+    X, counts, exposure = _data()
+    for family, y, family_exposure in [('Poisson', counts, exposure), ('Gaussian', counts / exposure, None)]:
+        fit = regularization_path(X, y, family, family_exposure, alphas=[1e-12], k=3)
+        reference = sm.GLM(y, X, family=getattr(sm.families, family)(), exposure=family_exposure).fit()
+
+        np.testing.assert_allclose(fit.params, reference.params, rtol=1e-6)
+        np.testing.assert_allclose(fit.predict(X), reference.predict(X), rtol=1e-6)
+
+# =========================================================================== #
+
+def test_predictions_survive_centering():
+
+    # With a strong penalty the covariate coefficients shrink, but the
+    # unpenalized intercept of the canonical Poisson link still matches the
+    # total count: this only holds if the intercept was moved back correctly
+    X, counts, exposure = _data()
+    fit = regularization_path(X, counts, 'Poisson', exposure, alphas=[1.0], k=3)
+
+    np.testing.assert_allclose(np.sum(fit.predict(X) * exposure), counts.sum(), rtol=1e-6)
+
+    # Same predictions as a fit on the centered and scaled columns
+    center, scale = X[:, 1:].mean(axis=0), X[:, 1:].std(axis=0)
+    X_scaled = np.column_stack([X[:, 0], (X[:, 1:] - center) / scale])
+    params, converged, _ = ridge_irls(X_scaled, counts, sm.families.Poisson(), 1.0, np.log(exposure),
+                                      np.array([False, True, True]))
+    assert converged
+    np.testing.assert_allclose(fit.predict(X), np.exp(X_scaled @ params), rtol=1e-6)
+
+# =========================================================================== #
+
+def test_invalid_warm_start_falls_back():
+
+    # A start that overflows the mean restarts from the statsmodels start
+    X, counts, exposure = _data()
+    X = np.column_stack([X[:, 0], (X[:, 1:] - X[:, 1:].mean(axis=0)) / X[:, 1:].std(axis=0)])
+    args = (X, counts, sm.families.Poisson(), 1e-3, np.log(exposure), np.array([False, True, True]))
+
+    cold, cold_converged, _ = ridge_irls(*args)
+    warm, warm_converged, _ = ridge_irls(*args, start=np.array([1e3, 1e3, 1e3]))
+
+    assert cold_converged and warm_converged
+    np.testing.assert_allclose(warm, cold, rtol=1e-6)
+
+# =========================================================================== #
+
+def test_constant_columns_are_penalized():
+
+    # An all-zero basis function and a second intercept leave the path solvable
+    X, counts, exposure = _data()
+    X = np.column_stack([X, np.zeros(len(X)), np.ones(len(X))])
+    fit = regularization_path(X, counts, 'Poisson', exposure, alphas=np.logspace(0, -4, 5), k=3)
+
+    assert np.all(np.isfinite(fit.params))
+    assert fit.params[3] == 0 and abs(fit.params[4]) < 1e-6
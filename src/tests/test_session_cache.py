@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that session_cache entries are memory-mapped when up to date, rebuilt
+when a source file changes, and never left half written. Run from the src
+folder:
+    python -m pytest tests
+"""
+
+import os
+import json
+import numpy as np
+from functions import session_cache
+from functions.session_cache import load_session
+
+# =========================================================================== #
+
+def _write_session(folder, n_spikes: int = 400, n_pos: int = 2000, n_units: int = 5, seed: int = 0) -> tuple:
+
+    '''
+        Writes a small Axona session (tetrode, .cut and .pos files) with
+        random spikes, labels and a smooth random walk of the animal.
+    '''
+
+    rng = np.random.default_rng(seed)
+    base = os.path.join(str(folder), 'session')
+    samples = 50
+
+    times = np.sort(rng.integers(0, n_pos * 96000 // 50, n_spikes))
+    spikes = np.zeros(n_spikes, np.dtype([field for channel in range(1, 5) for field in
+                                          [('t%d' % channel, '>i4'), ('ch%d' % channel, 'i1', (samples,))]]))
+    for channel in range(1, 5):
+        spikes['t%d' % channel] = times
+        spikes['ch%d' % channel] = rng.integers(-128, 128, (n_spikes, samples))
+    header = ('duration %d\r\nnum_chans 4\r\ntimebase 96000 hz\r\nbytes_per_timestamp 4\r\n'
+              'samples_per_spike %d\r\nsample_rate 48000 hz\r\nbytes_per_sample 1\r\nnum_spikes %d\r\ndata_start'
+              % (n_pos // 50, samples, n_spikes))
+    with open(base + '.1', 'wb') as f:
+        f.write(header.encode() + spikes.tobytes() + b'\r\ndata_end\r\n')
+
+    _write_cut(base + '_1.cut', rng.integers(0, n_units, n_spikes))
+
+    position = np.zeros(n_pos, np.dtype([('t', '>i4')] + [(name, '>i2') for name in
+                                         ['x1', 'y1', 'x2', 'y2', 'numpix1', 'numpix2', 'total', 'unused']]))
+    walk = 200 + 150 * np.sin(np.cumsum(rng.normal(0, 1.5, (n_pos, 2)), axis=0) / 300)
+    position['t'] = np.arange(n_pos)
+    position['x1'], position['y1'] = walk[:, 0], walk[:, 1]
+    position['x2'], position['y2'] = walk[:, 0] + 5, walk[:, 1] + 5
+    position['numpix1'], position['numpix2'] = 40, 30
+    header = ('duration %d\r\nnum_colours 4\r\nmin_x 0\r\nmax_x 400\r\nmin_y 0\r\nmax_y 400\r\n'
+              'window_min_x 0\r\nwindow_max_x 767\r\ntimebase 50 hz\r\nbytes_per_timestamp 4\r\n'
+              'sample_rate 50.0 hz\r\npos_format t,x1,y1,x2,y2,numpix1,numpix2\r\nbytes_per_coord 2\r\n'
+              'pixels_per_metre 600\r\nnum_pos_samples %d\r\ndata_start' % (n_pos // 50, n_pos))
+    with open(base + '.pos', 'wb') as f:
+        f.write(header.encode() + position.tobytes() + b'\r\ndata_end\r\n')
+
+    return base + '.pos', base + '_1.cut', base + '.1'
+
+# ------------------------------------------- #
+
+def _write_cut(path: str, labels: np.ndarray) -> None:
+    with open(path, 'w') as f:
+        f.write('n_clusters: %d\nn_channels: 4\n' % (labels.max() + 1))
+        f.write('Exact_cut_for: session spikes: %d\n' % len(labels))
+        for start in range(0, len(labels), 25):
+            f.write(' '.join(str(label) for label in labels[start:start + 25]) + '\n')
+
+# ------------------------------------------- #
+
+def _entries(cache_dir) -> list:
+    return sorted(os.listdir(cache_dir))
+
+# ------------------------------------------- #
+
+def _labels(raw_spike_data) -> np.ndarray:
+
+    '''
+        Cut label of every spike, in tetrode file order.
+    '''
+
+    labels = np.empty(len(raw_spike_data.order), dtype=int)
+    labels[raw_spike_data.order] = np.repeat(np.arange(len(raw_spike_data)), raw_spike_data.counts)
+    return labels
+
+# ------------------------------------------- #
+
+def _assert_same_session(loaded: tuple, reference: tuple) -> None:
+
+    (spikes, empty_cell, position), (reference_spikes, reference_empty_cell, reference_position) = loaded, reference
+    for name in ['order', 'offsets', 'times']:
+        np.testing.assert_array_equal(getattr(spikes, name), getattr(reference_spikes, name))
+    assert empty_cell == reference_empty_cell
+
+    for array, reference_array in zip(position[:3] + position[4] + position[5:],
+                                      reference_position[:3] + reference_position[4] + reference_position[5:]):
+        np.testing.assert_array_equal(array, reference_array)
+    assert tuple(position[3]) == tuple(reference_position[3])
+
+# =========================================================================== #
+
+def test_reload_is_memory_mapped(tmp_path):
+
+    files = _write_session(tmp_path)
+    cache_dir = tmp_path / 'cache'
+
+    parsed = load_session(*files, 600, cache_dir=str(cache_dir))
+    assert len(_entries(cache_dir)) == 1
+    entry = cache_dir / _entries(cache_dir)[0]
+    with open(entry / 'manifest.json') as f:
+        manifest = json.load(f)
+    assert manifest['version'] == session_cache.CACHE_VERSION
+    assert [source[0] for source in manifest['sources']] == [os.path.abspath(file) for file in files]
+
+    cached = load_session(*files, 600, cache_dir=str(cache_dir))
+    assert isinstance(cached[0].times, np.memmap)
+    assert isinstance(cached[2][0], np.memmap)
+    _assert_same_session(cached, parsed)
+
+    # A different ppm is another entry
+    load_session(*files, 300, cache_dir=str(cache_dir))
+    assert len(_entries(cache_dir)) == 2
+
+# =========================================================================== #
+
+def test_modified_cut_file_rebuilds_entry(tmp_path):
+
+    pos_file, cut_file, tetrode_file = _write_session(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    first = load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+    labels = _labels(first[0])
+
+    # Same size, only the modification time tells the new labels apart
+    relabelled = labels.copy()
+    relabelled[labels == 1], relabelled[labels == 2] = 2, 1
+    size = os.path.getsize(cut_file)
+    _write_cut(cut_file, relabelled)
+    assert os.path.getsize(cut_file) == size
+    stat = os.stat(cut_file)
+    os.utime(cut_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    rebuilt = load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+    np.testing.assert_array_equal(_labels(rebuilt[0]), relabelled)
+    assert not isinstance(rebuilt[0].times, np.memmap)
+    assert len(_entries(cache_dir)) == 1
+
+    reloaded = load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+    assert isinstance(reloaded[0].times, np.memmap)
+    np.testing.assert_array_equal(_labels(reloaded[0]), relabelled)
+
+# =========================================================================== #
+
+def test_modified_pos_file_rebuilds_entry(tmp_path):
+
+    pos_file, cut_file, tetrode_file = _write_session(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+
+    # A longer recording of the animal, with the same modification time
+    stat = os.stat(pos_file)
+    _write_session(tmp_path, n_pos=3000)
+    os.utime(pos_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.path.getsize(pos_file) != stat.st_size
+
+    rebuilt = load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+    reloaded = load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+    assert isinstance(reloaded[2][2], np.memmap)
+    _assert_same_session(reloaded, rebuilt)
+    assert rebuilt[2][2][-1] > 50
+
+    entry = os.path.join(cache_dir, _entries(cache_dir)[0])
+    with open(os.path.join(entry, 'manifest.json')) as f:
+        assert json.load(f)['sources'][0][1] == os.path.getsize(pos_file)
+
+# =========================================================================== #
+
+def test_incomplete_entry_is_rebuilt(tmp_path):
+
+    files = _write_session(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    parsed = load_session(*files, 600, cache_dir=cache_dir)
+    entry = os.path.join(cache_dir, _entries(cache_dir)[0])
+
+    # Without a manifest the arrays of an entry are never read
+    os.remove(os.path.join(entry, 'manifest.json'))
+    os.remove(os.path.join(entry, 'spike_times.npy'))
+    rebuilt = load_session(*files, 600, cache_dir=cache_dir)
+    assert not isinstance(rebuilt[0].times, np.memmap)
+    assert os.path.exists(os.path.join(entry, 'spike_times.npy'))
+
+    # Nor with a corrupt one
+    with open(os.path.join(entry, 'manifest.json'), 'w') as f:
+        f.write('{"version": ')
+    rebuilt = load_session(*files, 600, cache_dir=cache_dir)
+    assert not isinstance(rebuilt[0].times, np.memmap)
+    _assert_same_session(load_session(*files, 600, cache_dir=cache_dir), parsed)
+
+# =========================================================================== #
+
+def test_failed_write_keeps_previous_entry(tmp_path, monkeypatch):
+
+    pos_file, cut_file, tetrode_file = _write_session(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+    entry = os.path.join(cache_dir, _entries(cache_dir)[0])
+    with open(os.path.join(entry, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    stat = os.stat(cut_file)
+    os.utime(cut_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    # The disk fills up half way through writing the new entry
+    save = np.save
+    saved = []
+    def failing_save(file, array):
+        if len(saved) == 3:
+            raise OSError('No space left on device')
+        saved.append(file)
+        save(file, array)
+    monkeypatch.setattr(session_cache.np, 'save', failing_save)
+
+    loaded = load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+    assert len(loaded[0].times) == 400
+    assert len(saved) == 3
+
+    # No temporary folder is left behind and the previous entry is untouched,
+    # so it is stale and still rebuilt once writing works again
+    assert _entries(cache_dir) == [os.path.basename(entry)]
+    with open(os.path.join(entry, 'manifest.json')) as f:
+        assert json.load(f) == manifest
+    monkeypatch.undo()
+
+    load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)
+    with open(os.path.join(entry, 'manifest.json')) as f:
+        assert json.load(f)['sources'][1][2] == stat.st_mtime_ns + 10**9
+    assert isinstance(load_session(pos_file, cut_file, tetrode_file, 600, cache_dir=cache_dir)[0].times, np.memmap)
+
+# =========================================================================== #
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Latest-wins scheduling of GUI computations on a bounded thread pool.
+"""
+
+from collections import deque
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+# =========================================================================== #
+
+class JobSignals(QObject):
+    '''
+        Signals of a running job, tagged with its request id.
+
+        progress
+            request id, progress value
+
+        error
+            request id, error message
+
+        return_data
+            request id, tuple of return data from the job
+
+        finished
+            request id, emitted once the job stops, whatever the outcome
+    '''
+
+    progress = pyqtSignal(int, int)
+    error = pyqtSignal(int, str)
+    return_data = pyqtSignal(int, tuple)
+    finished = pyqtSignal(int)
+
+# =========================================================================== #
+
+class JobCallbacks:
+
+    '''
+        Pipeline callbacks (see compute_GLM.PipelineCallbacks) of a job.
+    '''
+
+    def __init__(self, job):
+        self.job = job
+
+    def progress(self, value):
+        self.job.signals.progress.emit(self.job.request_id, value)
+
+    def error(self, message):
+        self.job.signals.error.emit(self.job.request_id, message)
+
+    def is_cancelled(self):
+        return self.job.cancelled
+
+# =========================================================================== #
+
+class Job(QRunnable):
+
+    '''
+        Runs a function on the thread pool. The function receives JobCallbacks
+        as first argument.
+    '''
+
+    def __init__(self, request_id, function, *args, **kwargs):
+
+        QRunnable.__init__(self)
+        # The scheduler holds the reference, it may take the job back from the pool
+        self.setAutoDelete(False)
+        self.request_id = request_id
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+        self.signals = JobSignals()
+
+    # ------------------------------------------- #
+
+    def run(self):
+        try:
+            if not self.cancelled:
+                data = self.function(JobCallbacks(self), *self.args, **self.kwargs)
+                # Nothing to return if the function failed or was cancelled
+                if data is not None:
+                    self.signals.return_data.emit(self.request_id, tuple(data))
+        finally:
+            self.signals.finished.emit(self.request_id)
+
+# =========================================================================== #
+
+class JobScheduler(QObject):
+
+    '''
+        Runs jobs on a thread pool, only the newest request is of interest.
+        Submitting a job cancels every older one: queued jobs are taken back
+        from the pool, running jobs stop at their next cancellation check.
+        Progress, errors and results of older requests are dropped.
+
+        Prefetch jobs are speculative: they run one at a time at low priority,
+        only while no request is running, and are dropped by the next submit.
+
+        Signals:
+
+        result
+            tuple of return data of the newest request
+
+        completed
+            tag and tuple of return data of every job that finished its
+            work, including superseded ones, for caching
+
+        progress, error
+            Of the newest request
+    '''
+
+    result = pyqtSignal(tuple)
+    completed = pyqtSignal(object, tuple)
+    progress = pyqtSignal(int)
+    error = pyqtSignal(str)
+
+    def __init__(self, max_threads=2, parent=None):
+
+        QObject.__init__(self, parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        self.jobs = {}              # Unfinished jobs by request id
+        self.tags = {}              # Tag of every unfinished job
+        self.latest = None          # Request id of the newest request
+        self.next_id = 0
+        self.prefetch_queue = deque()
+
+    # ------------------------------------------- #
+
+    def submit(self, tag, function, *args, **kwargs):
+
+        '''
+            Cancels all jobs and runs function(callbacks, *args, **kwargs) as
+            the newest request. Returns its request id.
+        '''
+
+        self.cancel_all()
+        job = self._start(tag, function, args, kwargs)
+        self.latest = job.request_id
+
+        return job.request_id
+
+    # ------------------------------------------- #
+
+    def prefetch(self, tag, function, *args, **kwargs):
+
+        '''
+            Queues a speculative job, its result is only reported through
+            completed.
+        '''
+
+        self.prefetch_queue.append((tag, function, args, kwargs))
+        self._start_prefetch()
+
+    # ------------------------------------------- #
+
+    def _start(self, tag, function, args, kwargs, priority=0):
+
+        self.next_id += 1
+        job = Job(self.next_id, function, *args, **kwargs)
+        job.signals.progress.connect(self._progress)
+        job.signals.error.connect(self._error)
+        job.signals.return_data.connect(self._returned)
+        job.signals.finished.connect(self._finished)
+
+        self.jobs[job.request_id] = job
+        self.tags[job.request_id] = tag
+        self.pool.start(job, priority)
+
+        return job
+
+    # ------------------------------------------- #
+
+    def _start_prefetch(self):
+
+        # Idle time only, one speculative job at a time
+        if len(self.jobs) == 0 and len(self.prefetch_queue) > 0:
+            tag, function, args, kwargs = self.prefetch_queue.popleft()
+            self._start(tag, function, args, kwargs, priority=-1)
+
+    # ------------------------------------------- #
+
+    def cancel_all(self):
+
+        '''
+            Cancels every job and drops queued prefetch jobs, nothing is
+            reported until the next submit.
+        '''
+
+        self.latest = None
+        self.prefetch_queue.clear()
+        for request_id, job in list(self.jobs.items()):
+            job.cancelled = True
+            # Queued jobs never start
+            if self.pool.tryTake(job):
+                self._finished(request_id)
+
+    # ------------------------------------------- #
+
+    def _progress(self, request_id, value):
+        if request_id == self.latest:
+            self.progress.emit(value)
+
+    def _error(self, request_id, message):
+        if request_id == self.latest:
+            self.error.emit(message)
+
+    def _returned(self, request_id, data):
+        self.completed.emit(self.tags[request_id], data)
+        if request_id == self.latest:
+            self.result.emit(data)
+
+    def _finished(self, request_id):
+        self.jobs.pop(request_id, None)
+        self.tags.pop(request_id, None)
+        self._start_prefetch()
+
+# =========================================================================== #